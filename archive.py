@@ -0,0 +1,329 @@
+''' Export chat history into a local archive, then replay it to the destinations at their own pace. '''
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+
+from telethon import utils
+from telethon.errors.rpcerrorlist import FloodWaitError, TakeoutInitDelayError
+from telethon.extensions import BinaryReader
+from telethon.tl.patched import MessageService
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from settings import API_ID, API_HASH, ARCHIVE_DIR, ARCHIVE_MEDIA, forwards, get_forward, update_offset, checkpoints
+from scheduler import group_by_source, run_pairs
+from dedup import dedup
+import metrics
+import memory
+from sessionpool import SessionPool, account_of, build_sessions
+from pipeline import Record, prefetch_messages, iter_chunks, as_message
+from strategy import deliver
+from transfer import pipeline
+from peers import intify, preflight, resolve
+from ratelimit import RateLimiter
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+CONFIG = {
+    'BATCH_SIZE': 100,  # Messages per forward request when replaying (Telegram allows at most 100)
+    'INITIAL_RATE': 2,  # Replay requests per second until a rate has been learned
+    'COMMIT_EVERY': 100,  # Archived messages per index commit
+}
+
+limiter = RateLimiter(initial_rate=CONFIG['INITIAL_RATE'])
+
+
+class Archive:
+    """
+    An append-only, resumable copy of the source chats on disk.
+
+    Every chat has a log file of length-prefixed messages in Telegram's own
+    serialization, which is compact and reads back into the same Message
+    objects. An SQLite index maps (chat, message id) to the position of the
+    record in the log, so replay can start at any offset without scanning.
+    Media files are stored once under the hash of their content, however
+    many messages or chats use them. The peer id of every exported chat is
+    stored under its config.ini name, so a replay finds its messages even
+    when the chat can no longer be resolved.
+
+    The log is written before the index, so after a crash the index never
+    points past the data; an unindexed tail is just skipped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.join(path, 'media'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS records (chat INTEGER NOT NULL, id INTEGER NOT NULL, '
+            'position INTEGER NOT NULL, length INTEGER NOT NULL, media TEXT, '
+            'PRIMARY KEY (chat, id)) WITHOUT ROWID'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS chats (name TEXT PRIMARY KEY, chat INTEGER NOT NULL)')
+        self.db.commit()
+        self.logs = {}
+        self.added = 0
+
+    def _log(self, chat: int):
+        if chat not in self.logs:
+            self.logs[chat] = open(os.path.join(self.path, f'{chat}.log'), 'ab')
+        return self.logs[chat]
+
+    def last_id(self, chat: int) -> int:
+        """The newest archived message id of `chat` (0 if none)"""
+        return self.db.execute('SELECT MAX(id) FROM records WHERE chat = ?', (chat,)).fetchone()[0] or 0
+
+    def name(self, name: str, chat: int) -> None:
+        """Store that the config.ini chat `name` has peer id `chat`"""
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO chats VALUES (?, ?)', (name, chat))
+
+    def chat_id(self, name: str):
+        """The stored peer id of the config.ini chat `name`, the id itself if `name` is one, or None"""
+        row = self.db.execute('SELECT chat FROM chats WHERE name = ?', (name,)).fetchone()
+        if row:
+            return row[0]
+        chat = intify(name)
+        return chat if isinstance(chat, int) else None
+
+    def media_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'media', digest[:2], digest)
+
+    def store_media(self, path: str) -> str:
+        """Move a downloaded file into the media store and return its content hash"""
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as data:
+            for block in iter(lambda: data.read(1 << 20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        target = self.media_path(digest)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        return digest
+
+    def append(self, chat: int, message, media: str = None) -> None:
+        data = bytes(message)
+        log = self._log(chat)
+        position = log.tell()
+        log.write(len(data).to_bytes(4, 'little') + data)
+        self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                        (chat, message.id, position + 4, len(data), media))
+        self.added += 1
+        if self.added % CONFIG['COMMIT_EVERY'] == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        for log in self.logs.values():
+            log.flush()
+            os.fsync(log.fileno())
+        self.db.commit()
+
+    async def read(self, chat: int, offset: int):
+        """Yield (Record, media path or None) of the messages of `chat` newer than `offset`, oldest first"""
+        rows = self.db.execute(
+            'SELECT position, length, media FROM records WHERE chat = ? AND id > ? ORDER BY id', (chat, offset))
+        with open(os.path.join(self.path, f'{chat}.log'), 'rb') as log:
+            for position, length, media in rows:
+                log.seek(position)
+                message = BinaryReader(log.read(length)).tgread_object()
+                if isinstance(message, MessageService):
+                    continue
+                yield Record(message), self.media_path(media) if media else None
+
+
+archive = Archive(ARCHIVE_DIR)
+
+
+async def download(client, message):
+    """Download the photo or document of `message` into the media store; None for other messages"""
+    if not isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument)):
+        return None
+    partial = os.path.join(archive.path, 'media', f'{message.id}.part')
+    while True:
+        try:
+            with metrics.timed('download_media'):
+                path = await client.download_media(message, file=partial)
+            break
+        except FloodWaitError as fwe:
+            logging.warning(f'Flood wait for downloading media: {fwe.seconds} seconds')
+            metrics.retry('download_media')
+            await asyncio.sleep(fwe.seconds)
+    return archive.store_media(path) if path else None
+
+
+async def export_chat(client, chat) -> int:
+    """Append the messages of `chat` newer than the archive to it and return how many were added"""
+    peer = await resolve(client, chat)
+    key = utils.get_peer_id(peer)
+    archive.name(str(chat), key)
+    offset = archive.last_id(key)
+    logging.info('Exporting %s from message %s', chat, offset)
+    exported = 0
+    try:
+        async for message in prefetch_messages(client, peer, offset, raw=True):
+            media = await download(client, message) if ARCHIVE_MEDIA else None
+            archive.append(key, message, media)
+            exported += 1
+            metrics.count(str(chat), 'exported')
+    finally:
+        archive.flush()
+    logging.info('Exported %s messages of %s (up to %s)', exported, chat, archive.last_id(key))
+    return exported
+
+
+async def export_job(pool, takeout: bool):
+    """Export every `from` chat of config.ini, through a takeout session if asked"""
+    client = pool.main
+    sources = [get_forward(group[0])[0] for group in group_by_source(forwards)]
+    if not takeout:
+        for chat in sources:
+            await export_chat(client, chat)
+        return
+    try:
+        async with client.takeout(finalize=True, users=True, chats=True, megagroups=True, channels=True,
+                                  files=ARCHIVE_MEDIA) as takeout_client:
+            for chat in sources:
+                await export_chat(takeout_client, chat)
+    except TakeoutInitDelayError as err:
+        logging.warning(f'Telegram delays the takeout session by {err.seconds} seconds, exporting without it')
+        for chat in sources:
+            await export_chat(client, chat)
+
+
+async def safe_forward(client, to_chat, from_peer, ids):
+    """Forward archived message ids from the source chat with flood wait handling"""
+    while True:
+        try:
+            return await limiter.call(lambda: client.forward_messages(to_chat, ids, from_peer=from_peer),
+                                      to_chat, 'forward_messages', account_of(client))
+        except FloodWaitError as fwe:
+            logging.warning(f'Flood wait for forwarding message: {fwe.seconds} seconds')
+            metrics.retry('forward_messages')
+            await asyncio.sleep(fwe.seconds)
+
+
+async def safe_copy(client, to_chat, album, files, reply_to=None):
+    """Send one archived message or album, uploading the stored media files where there are any"""
+    if any(files.get(m.id) for m in album):
+        media = await pipeline.media(client, album, files)
+    else:
+        media = [m.media for m in album]
+    if len(album) == 1 and not files.get(album[0].id):
+        send = lambda: client.send_message(to_chat, as_message(album[0]), reply_to=reply_to)
+        method = 'send_message'
+    elif len(album) == 1:
+        send = lambda: client.send_file(to_chat, media[0], caption=album[0].message or '',
+                                        formatting_entities=album[0].entities, reply_to=reply_to)
+        method = 'send_file'
+    else:
+        send = lambda: client.send_file(to_chat, media, caption=[m.message or '' for m in album],
+                                        formatting_entities=[m.entities or [] for m in album], reply_to=reply_to)
+        method = 'send_file'
+    while True:
+        try:
+            return await limiter.call(send, to_chat, method, account_of(client))
+        except FloodWaitError as fwe:
+            logging.warning(f'Flood wait for copying message: {fwe.seconds} seconds')
+            metrics.retry(method)
+            await asyncio.sleep(fwe.seconds)
+
+
+async def replay_pair(client, forward):
+    """Send the archived messages of one config.ini section after its offset and return its offset report"""
+    from_chat, to_chat, offset = get_forward(forward)
+    offset = offset or 0
+    last_id = 0
+    error_occurred = False
+    to_peer = await resolve(client, to_chat)
+    from_peer, copy_only = None, False
+    files = {}
+    try:
+        from_peer = await resolve(client, from_chat)
+        await client.get_messages(from_peer, limit=1)
+        chat = utils.get_peer_id(from_peer)
+    except Exception as err:
+        # Only this replay copies; the source itself may still allow forwarding
+        chat, copy_only = archive.chat_id(str(from_chat)), True
+        if chat is None:
+            logging.error(f'Cannot read {from_chat} ({err}) and it was never exported')
+            return {'from': from_chat, 'to': to_chat, 'final_offset': offset, 'error': True}
+        logging.warning(f'Cannot read {from_chat} ({err}), sending copies from the archive')
+
+    async def messages():
+        async for message, media in archive.read(chat, offset):
+            if media:
+                files[message.id] = media
+            yield message
+
+    try:
+        async for chunk in iter_chunks(messages(), CONFIG['BATCH_SIZE']):
+            fresh = dedup.fresh(to_chat, chunk) if dedup else chunk
+            if len(fresh) < len(chunk):
+                metrics.count(forward, 'skipped', len(chunk) - len(fresh))
+            # Forward by id while the source still has the messages, copy from the archive otherwise
+            await deliver(client, from_peer, forward, fresh,
+                          lambda batch: safe_forward(client, to_peer, from_peer, [m.id for m in batch]),
+                          lambda album, reply_to: safe_copy(client, to_peer, album, files, reply_to),
+                          lambda album: pipeline.prepare(client, album, files), copy_only=copy_only)
+            if fresh:
+                metrics.count(forward, 'forwarded', len(fresh))
+                logging.info('Replayed messages up to id = %s', fresh[-1].id)
+            if dedup:
+                for m in fresh:
+                    dedup.add(to_chat, m)
+            last_id = chunk[-1].id
+            update_offset(forward, str(last_id))
+            for m in chunk:
+                files.pop(m.id, None)
+    except Exception as err:
+        logging.exception(err)
+        metrics.count(forward, 'failed')
+        error_occurred = True
+
+    logging.info('Completed replay for %s', forward)
+    return {
+        'from': from_chat,
+        'to': to_chat,
+        'final_offset': last_id or offset,
+        'error': error_occurred
+    }
+
+
+async def archive_job(mode: str, takeout: bool = False):
+    """Run the export or the replay phase for every config.ini section"""
+    sessions = build_sessions()
+    assert API_ID is not None and API_HASH is not None, "API_ID and API_HASH must be set"
+
+    async with SessionPool(sessions, int(API_ID), str(API_HASH)) as pool, metrics.Exporter(), memory.Monitor(pool):
+        # A replay may run from a backup whose source is gone, so only its destinations have to work
+        await preflight(pool, forwards, sources=(mode == 'export'))
+        if mode == 'export':
+            await export_job(pool, takeout)
+            return
+        reports = await run_pairs(forwards, replay_pair, pool)
+        limiter.save()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
+        for report in reports:
+            logging.info('%s → %s: offset %s%s', report['from'], report['to'], report['final_offset'],
+                         ' (with errors)' if report['error'] else '')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('mode', choices=['export', 'replay'],
+                        help='export: copy the `from` chats into the archive; replay: send the archive to the `to` chats')
+    parser.add_argument('--takeout', action='store_true', help='export through a takeout session (looser history limits)')
+    args = parser.parse_args()
+
+    assert forwards, "No forwards configured in settings.py"
+    asyncio.run(archive_job(args.mode, takeout=args.takeout))
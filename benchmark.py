@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Offline throughput benchmark of the forwarding engines against a simulated Telegram.
+
+Every engine runs its forward_pair() through scheduler.run_pairs against
+fake_client.FakeTelegramClient, on a simulated clock: sleeps (latency,
+pacing, flood waits) take no real time, so a million-message channel is
+measured in seconds. Each engine runs in its own process, so peak RSS is its
+own.
+
+    python benchmark.py --messages 100000
+    python benchmark.py --engine slow_forward --messages 1000000 --server-rate 20
+    python benchmark.py --engine safe --pairs 3 --messages 300 --weights 1,1,5
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Engines are modules with a forward_pair(client, forward) coroutine
+ENGINES = ['forwarder', 'safe', 'slow_forward']
+
+
+class SimulatedClockLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock jumps to the next timer whenever nothing is ready to run"""
+
+    def __init__(self):
+        super().__init__()
+        self._clock = 0.0
+
+    def time(self) -> float:
+        return self._clock
+
+    def _run_once(self):
+        # Drop cancelled timers first, as the base loop would, so the jump goes to a live one
+        while self._scheduled and self._scheduled[0]._cancelled:
+            self._timer_cancelled_count -= 1
+            heapq.heappop(self._scheduled)._scheduled = False
+        if not self._ready and self._scheduled:
+            self._clock = max(self._clock, self._scheduled[0]._when)
+        super()._run_once()
+
+
+def run_engine(args) -> dict:
+    """Run one engine in this process and return its measurements"""
+    workdir = tempfile.mkdtemp(prefix='forward-bench-')
+    # Keep the benchmark away from the real checkpoints, ledger and learned rates
+    os.environ['CHECKPOINT_FILE'] = os.path.join(workdir, 'checkpoints.db')
+    os.environ['DEDUP'] = 'false'
+    os.environ['MAX_CONCURRENT_PAIRS'] = str(args.pairs)
+    os.environ['PER_DESTINATION_LIMIT'] = '1'
+    os.environ['FETCH_SHARDS'] = str(args.fetch_shards)
+    os.environ.setdefault('api_id', '0')
+    os.environ.setdefault('api_hash', 'benchmark')
+
+    import ratelimit
+    ratelimit.CONFIG['STATE_FILE'] = os.path.join(workdir, 'rate_limits.json')
+
+    import logging
+    import settings
+    from fake_client import FakePool, FakeTelegramClient
+    from memory import peak_rss_mb
+    from scheduler import fairness, run_pairs
+
+    engine = __import__(args.engine)
+    logging.getLogger().setLevel(args.log_level)
+
+    forwards = []
+    for number in range(1, args.pairs + 1):
+        section = f'bench{number}'
+        settings.configur[section] = {'from': str(number), 'to': str(1000 + number), 'offset': '0'}
+        for key, values in (('weight', args.weights), ('priority', args.priorities)):
+            if values:
+                settings.configur[section][key] = values.split(',')[number - 1]
+        forwards.append(section)
+
+    client = FakeTelegramClient(
+        args.messages, latency=args.latency, server_rate=args.server_rate,
+        flood_probability=args.flood_probability, flood_seconds=args.flood_seconds,
+        flood_sleep_threshold=args.flood_sleep_threshold, restricted=args.restricted,
+        media_size=args.media_size * 1024)
+
+    loop = SimulatedClockLoop()
+    started = time.perf_counter()
+    try:
+        loop.run_until_complete(run_pairs(forwards, engine.forward_pair, FakePool(client)))
+    finally:
+        loop.close()
+    settings.checkpoints.flush()
+
+    simulated = loop.time()
+    forwarded = sum(client.sent.values())
+    peak = peak_rss_mb()  # None on Windows
+    return {
+        'engine': args.engine,
+        'messages': args.messages * args.pairs,
+        'forwarded': forwarded,
+        'simulated_seconds': round(simulated, 1),
+        'msgs_per_min': round(forwarded / simulated * 60, 1) if simulated else None,
+        'requests': sum(client.requests.values()),
+        'requests_by_method': dict(client.requests),
+        'flood_waits': client.flood_waits,
+        'flood_wait_seconds': client.flood_wait_seconds,
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+        'wall_seconds': round(time.perf_counter() - started, 1),
+        'sections': fairness(forwards),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', default='all', help=f'one of {", ".join(ENGINES)}, or all (default)')
+    parser.add_argument('--messages', type=int, default=10000, help='messages per source channel (default 10000)')
+    parser.add_argument('--pairs', type=int, default=1, help='forward sections, each with its own channel (default 1)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request (default 0.05)')
+    parser.add_argument('--server-rate', type=float, default=30, help='requests/second per method before flood waits (default 30)')
+    parser.add_argument('--flood-probability', type=float, default=0.0, help='chance of a random flood wait per request')
+    parser.add_argument('--flood-seconds', type=int, default=30, help='length of a random flood wait (default 30)')
+    parser.add_argument('--flood-sleep-threshold', type=int, default=60, help='flood waits slept inside requests the rate limiter does not pace (default 60)')
+    parser.add_argument('--restricted', action='store_true', help='sources restrict forwarding, so media is re-uploaded')
+    parser.add_argument('--media-size', type=int, default=256, help='size of every photo in KB (default 256)')
+    parser.add_argument('--fetch-shards', type=int, default=1, help='history pages fetched in parallel (default 1)')
+    parser.add_argument('--weights', help='comma-separated weight of every section, e.g. 1,1,5')
+    parser.add_argument('--priorities', help='comma-separated priority of every section, e.g. 0,0,5')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the engines (default WARNING)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    if args.engine != 'all':
+        result = run_engine(args)
+        sections = result.pop('sections')
+        print(json.dumps(result) if args.json else '\n'.join(f'{k}: {v}' for k, v in result.items()))
+        if not args.json and (args.weights or args.priorities):
+            print('\n'.join(sections))
+        return
+
+    # One process per engine, so peak RSS and module state are not shared
+    results = []
+    for engine in ENGINES:
+        command = [sys.executable, __file__, '--engine', engine, '--json'] + [
+            arg for arg in sys.argv[1:] if arg != '--json']
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    columns = ['engine', 'forwarded', 'msgs_per_min', 'requests', 'flood_waits', 'flood_wait_seconds', 'peak_rss_mb']
+    print('  '.join(f'{c:>18}' for c in columns))
+    for result in results:
+        print('  '.join(f'{str(result[c]):>18}' for c in columns))
+
+
+if __name__ == "__main__":
+    main()
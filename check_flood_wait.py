@@ -1,35 +1,57 @@
 #!/usr/bin/env python3
 """
-Script to help determine when you can run the forwarder again after a FloodWaitError.
+Resume forwards automatically once their flood wait is over.
+
+Every FloodWaitError is written to the flood-wait ledger (see floodledger.py).
+When a flood wait is too long to sit out, safe.py stops that forward and
+queues it instead. This script waits until the earliest queued deadline and
+then runs the same script again for just the due sections. It keeps going
+until nothing is queued.
 """
 
-import time
 import datetime
+import os
+import subprocess
+import sys
+import time
+
+import floodledger
+
 
 def main():
-    # The flood wait time from your error (in seconds)
-    flood_wait_seconds = 2891  # Change this to your actual wait time
-    
-    # Calculate when you can run the script again
-    now = datetime.datetime.now()
-    wait_until = now + datetime.timedelta(seconds=flood_wait_seconds)
-    
-    print(f"Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"You need to wait {flood_wait_seconds} seconds ({flood_wait_seconds // 60:.1f} minutes)")
-    print(f"You can run the forwarder again after: {wait_until.strftime('%Y-%m-%d %H:%M:%S')}")
-    
-    # If you want to wait and then automatically run the forwarder
-    choice = input("\nDo you want to wait and then automatically run the forwarder? (y/N): ")
-    if choice.lower() == 'y':
-        print(f"Waiting {flood_wait_seconds} seconds...")
-        time.sleep(flood_wait_seconds)
-        print("Wait complete! You can now run the forwarder.")
-        
-        # Optionally run the forwarder automatically
-        run_now = input("Do you want to run the forwarder now? (y/N): ")
-        if run_now.lower() == 'y':
-            import subprocess
-            subprocess.run(["python", "forwarder.py"])
+    while True:
+        entries = floodledger.pending()
+        if not entries:
+            print("No deferred forwards are queued.")
+            return
+
+        now = datetime.datetime.now()
+        print(f"Current time: {now.strftime('%Y-%m-%d %H:%M:%S')}")
+        for _, account, method, pair, script, deadline in entries:
+            wait_until = datetime.datetime.fromtimestamp(deadline)
+            print(f"  {pair} ({script}, {account}, {method}) can run again after: {wait_until.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        flood_wait_seconds = entries[0][5] - time.time()
+        if flood_wait_seconds > 0:
+            print(f"Waiting {flood_wait_seconds:.0f} seconds ({flood_wait_seconds / 60:.1f} minutes)...")
+            time.sleep(flood_wait_seconds)
+
+        # Run every script once for all of its sections that are due now
+        due = {}
+        for entry_id, _, _, pair, script, deadline in floodledger.pending():
+            if deadline <= time.time():
+                due.setdefault(script, {})[entry_id] = pair
+
+        for script, pairs in due.items():
+            floodledger.mark_resumed(pairs.keys())
+            sections = sorted({pair for pair in pairs.values() if pair})
+            if not sections:
+                continue
+            print(f"Wait complete! Resuming {', '.join(sections)} with {script}")
+            env = dict(os.environ, FORWARD_SECTIONS=','.join(sections))
+            # The newline answers the [ENTER] confirmation of forwarder.py
+            subprocess.run([sys.executable, script], input='\n', text=True, env=env)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
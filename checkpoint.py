@@ -0,0 +1,169 @@
+''' A small SQLite store that keeps the offset of every forward section and its source-to-destination id map. '''
+
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """
+    Keeps section offsets in SQLite (WAL mode) and commits them in batches.
+
+    Offsets are buffered in memory and written once `batch_size` updates have
+    piled up or `interval` seconds have passed, so a crash loses at most one
+    batch, which is forwarded again on the next run.
+
+    Every row also remembers the config.ini offset it started from. When the
+    user edits the offset in config.ini, the edited value wins again.
+
+    Next to the offsets, every sent message is mapped from its source id to
+    its destination id, and whether it went out as a copy. Map entries are
+    buffered with the offsets and committed in the same transaction, so the
+    map always covers the committed offset.
+
+    Sends are bracketed by begin() and confirm(). Every commit also records,
+    for each section with a send in flight, the first source id of that
+    send; the first send of a section after a commit without one commits
+    right away to record it. So a section whose record is still there after
+    a crash or a cancelled send may have sent messages from that id on,
+    at most one batch past its committed offset, and those are checked
+    against the destination on the next run (see shutdown.resume). That
+    costs at most one extra commit per batch, not one per send.
+    """
+
+    def __init__(self, path: str, batch_size: int = 50, interval: float = 5.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = {}
+        self.pending_map = {}  # (section, source id) -> (destination id, copied)
+        self.in_flight = {}  # section -> (first, last) source ids of the send it has in flight
+        self.updates = 0
+        self.last_flush = time.monotonic()
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS offsets ('
+            'section TEXT PRIMARY KEY, offset INTEGER NOT NULL, config_offset INTEGER NOT NULL, updated REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS message_map (section TEXT NOT NULL, source INTEGER NOT NULL, '
+            'destination INTEGER NOT NULL, copied INTEGER NOT NULL, PRIMARY KEY (section, source)) WITHOUT ROWID'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS in_flight ('
+            'section TEXT PRIMARY KEY, first INTEGER NOT NULL, last INTEGER NOT NULL, started REAL NOT NULL)'
+        )
+        self.db.commit()
+        # Sections with an in-flight record in the database
+        self.recorded = {section for section, in self.db.execute('SELECT section FROM in_flight')}
+
+    def get(self, section: str, config_offset: int) -> int:
+        """Return the stored offset of `section`, or `config_offset` if there is none or config.ini was edited"""
+        if section in self.pending:
+            offset, base = self.pending[section]
+        else:
+            row = self.db.execute(
+                'SELECT offset, config_offset FROM offsets WHERE section = ?', (section,)).fetchone()
+            if row is None:
+                return config_offset
+            offset, base = row
+        return offset if base == config_offset else config_offset
+
+    def set(self, section: str, offset: int, config_offset: int) -> None:
+        """Buffer a new offset for `section` and commit the batch when it is due"""
+        self.pending[section] = (offset, config_offset)
+        self.updates += 1
+        if self.updates >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def map(self, section: str, source: int, destination: int, copied: bool) -> None:
+        """Buffer the destination id of source message `source` of `section`"""
+        self.pending_map[(section, source)] = (destination, int(copied))
+        self.updates += 1
+        if self.updates >= self.batch_size:
+            self.flush()
+
+    def destination(self, section: str, source: int):
+        """The (destination id, copied) of source message `source` of `section`, or None if it was not sent"""
+        if (section, source) in self.pending_map:
+            return self.pending_map[(section, source)]
+        return self.db.execute('SELECT destination, copied FROM message_map WHERE section = ? AND source = ?',
+                               (section, source)).fetchone()
+
+    def mapped(self, section: str, first: int, last: int) -> dict:
+        """{source id: destination id} of the sent messages of `section` with `first` <= source id <= `last`"""
+        self.flush()
+        return dict(self.db.execute(
+            'SELECT source, destination FROM message_map WHERE section = ? AND source BETWEEN ? AND ?',
+            (section, first, last)))
+
+    def first_mapped(self, section: str):
+        """The oldest source id of `section` in the map, or None if nothing was mapped"""
+        self.flush()
+        return self.db.execute('SELECT MIN(source) FROM message_map WHERE section = ?', (section,)).fetchone()[0]
+
+    def last_destination(self, section: str, before: int):
+        """The destination id of the newest message of `section` sent before source id `before`, or None"""
+        self.flush()
+        row = self.db.execute('SELECT destination FROM message_map WHERE section = ? AND source < ? '
+                              'ORDER BY source DESC LIMIT 1', (section, before)).fetchone()
+        return row[0] if row else None
+
+    def begin(self, section: str, first: int, last: int) -> None:
+        """Source ids `first` to `last` of `section` are being sent; committed now if nothing records it yet"""
+        self.in_flight[section] = (first, last)
+        if section not in self.recorded:
+            self.flush()
+
+    def confirm(self, section: str) -> None:
+        """The messages of the last begin() of `section` were sent and its offset set"""
+        self.in_flight.pop(section, None)
+
+    def unconfirmed(self, section: str):
+        """The first source id `section` may have sent without a committed offset, or None if there is none"""
+        if section not in self.recorded:
+            return None
+        return self.db.execute('SELECT first FROM in_flight WHERE section = ?', (section,)).fetchone()[0]
+
+    def settle(self, section: str) -> None:
+        """Commit the buffer and drop the in-flight record of `section` once it has been checked"""
+        self.confirm(section)
+        self.flush()
+
+    def forget(self, section: str, sources) -> None:
+        """Drop the map entries of deleted source messages"""
+        for source in sources:
+            self.pending_map.pop((section, source), None)
+        with self.db:
+            self.db.executemany('DELETE FROM message_map WHERE section = ? AND source = ?',
+                                [(section, source) for source in sources])
+
+    def flush(self) -> None:
+        """Commit every buffered offset and map entry in one transaction"""
+        self.last_flush = time.monotonic()
+        self.updates = 0
+        if not self.pending and not self.pending_map and self.recorded == self.in_flight.keys():
+            return
+        now = time.time()
+        with self.db:
+            # Sections with a send in flight keep a record from it; the others have nothing unconfirmed
+            self.db.executemany('DELETE FROM in_flight WHERE section = ?',
+                                [(section,) for section in self.recorded - self.in_flight.keys()])
+            self.db.executemany('INSERT OR REPLACE INTO in_flight VALUES (?, ?, ?, ?)',
+                                [(section, first, last, now) for section, (first, last) in self.in_flight.items()
+                                 if section not in self.recorded])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO offsets (section, offset, config_offset, updated) VALUES (?, ?, ?, ?)',
+                [(section, offset, base, now) for section, (offset, base) in self.pending.items()]
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO message_map VALUES (?, ?, ?, ?)',
+                [(section, source, destination, copied)
+                 for (section, source), (destination, copied) in self.pending_map.items()]
+            )
+        self.pending.clear()
+        self.pending_map.clear()
+        self.recorded = set(self.in_flight)
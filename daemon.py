@@ -0,0 +1,91 @@
+''' Keep forwarding new messages after the catch-up, instead of exiting. '''
+
+import asyncio
+import logging
+
+from telethon import events, utils
+
+from settings import DAEMON_POLL_INTERVAL, get_forward, checkpoints
+from scheduler import group_by_source, new_limits, run_pairs
+from peers import resolve
+from shutdown import stopping
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 5  # Seconds before a failed catch-up is retried, doubling up to DAEMON_POLL_INTERVAL
+
+
+async def run_daemon(pool, forwards, forward_pair):
+    """
+    Forward new messages of every `from` chat as they arrive, until cancelled.
+
+    Each source has a worker that reruns its sections with run_pairs whenever
+    an events.NewMessage handler sees a post in that chat. The worker starts
+    from the saved offsets, so nothing is skipped or sent twice, and a burst
+    of posts costs one catch-up. Workers also catch up every
+    DAEMON_POLL_INTERVAL seconds and after a client reconnects, which fills
+    any gap left by a disconnect. A catch-up that fails (a network error, a
+    chat that cannot be resolved) is logged and retried after a growing
+    delay. The workers share MAX_CONCURRENT_PAIRS and PER_DESTINATION_LIMIT.
+    After a shutdown signal (shutdown.py), every worker finishes its
+    catch-up and the daemon returns.
+    """
+    limits = new_limits()
+    groups = group_by_source(forwards)
+    triggers = [asyncio.Event() for _ in groups]
+    sources = {}
+    for group, trigger in zip(groups, triggers):
+        from_chat, _, _ = get_forward(group[0])
+        sources[utils.get_peer_id(await resolve(pool.main, from_chat))] = trigger
+        # Catch up once at start for anything posted since the last run
+        trigger.set()
+
+    async def on_new_message(event):
+        trigger = sources.get(event.chat_id)
+        if trigger:
+            trigger.set()
+
+    for client in pool.clients:
+        client.add_event_handler(on_new_message, events.NewMessage(chats=list(sources)))
+
+    async def worker(group, trigger):
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(trigger.wait(), timeout=DAEMON_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            trigger.clear()
+            if stopping():
+                return
+            try:
+                await run_pairs(group, forward_pair, pool, limits)
+                failures = 0
+            except Exception as err:
+                failures += 1
+                delay = min(RETRY_DELAY * 2 ** (failures - 1), DAEMON_POLL_INTERVAL)
+                logger.exception(f'Catch-up of {", ".join(group)} failed, retrying in {delay}s: {err}')
+                await asyncio.sleep(delay)
+                trigger.set()
+            checkpoints.flush()
+
+    async def watch_connections():
+        connected = [client.is_connected() for client in pool.clients]
+        while not stopping():
+            await asyncio.sleep(5)
+            now = [client.is_connected() for client in pool.clients]
+            if any(now[i] and not connected[i] for i in range(len(now))):
+                logger.info('Client reconnected, catching up on every source')
+                for trigger in triggers:
+                    trigger.set()
+            connected = now
+        # Wake the idle workers so they see the shutdown
+        for trigger in triggers:
+            trigger.set()
+
+    logger.info(f'Daemon mode: listening to {len(groups)} source chat(s)')
+    try:
+        await asyncio.gather(watch_connections(), *(worker(g, t) for g, t in zip(groups, triggers)))
+    finally:
+        for client in pool.clients:
+            client.remove_event_handler(on_new_message)
@@ -0,0 +1,131 @@
+''' An on-disk index of forwarded content, used to skip reposts and overlapping pairs. '''
+
+import atexit
+import hashlib
+import logging
+import math
+import sqlite3
+
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from settings import DEDUP, DEDUP_FILE, DEDUP_EXPECTED
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(message):
+    """
+    A content key for `message`: the media file id plus the normalized text.
+
+    Returns None for messages without media or text, which are never treated
+    as duplicates.
+    """
+    media = ''
+    if isinstance(message.media, MessageMediaPhoto) and message.media.photo:
+        media = f'photo:{message.media.photo.id}'
+    elif isinstance(message.media, MessageMediaDocument) and message.media.document:
+        media = f'document:{message.media.document.id}'
+    elif message.media:
+        # Other media (polls, locations, ...) has no file id, so it is never deduplicated
+        return None
+    text = ' '.join((message.message or '').split()).casefold()
+    if not media and not text:
+        return None
+    return hashlib.blake2b(f'{media}|{text}'.encode(), digest_size=16).digest()
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter answering 'definitely not seen' without touching the disk"""
+
+    def __init__(self, expected: int, error_rate: float = 0.01):
+        self.size = max(8, int(-expected * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / expected * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes):
+        # Double hashing over the two halves of the fingerprint
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: bytes) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DedupIndex:
+    """
+    Remembers which content was already sent to which destination.
+
+    Fingerprints live in SQLite, so the index can hold millions of entries;
+    a Bloom filter sized for DEDUP_EXPECTED entries sits in front of it, so
+    new content (the common case) never hits the disk. Memory stays at the
+    size of the filter.
+    """
+
+    def __init__(self, path: str, expected: int):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS sent (destination TEXT NOT NULL, fingerprint BLOB NOT NULL, '
+            'PRIMARY KEY (destination, fingerprint)) WITHOUT ROWID'
+        )
+        self.bloom = BloomFilter(expected)
+        for destination, key in self.db.execute('SELECT destination, fingerprint FROM sent'):
+            self.bloom.add(self._key(destination, key))
+        self.added = 0
+
+    @property
+    def skipped(self) -> int:
+        """Sends saved so far: the callers count what they skip in the `skipped` metric of their section"""
+        return sum(counters.get('skipped', 0) for counters in metrics.pair_counters.values())
+
+    @staticmethod
+    def _key(destination, key: bytes) -> bytes:
+        return hashlib.blake2b(str(destination).encode() + key, digest_size=16).digest()
+
+    def seen(self, destination, message) -> bool:
+        """True if the content of `message` was already sent to `destination`"""
+        key = fingerprint(message)
+        if key is None or self._key(destination, key) not in self.bloom:
+            return False
+        found = self.db.execute(
+            'SELECT 1 FROM sent WHERE destination = ? AND fingerprint = ?', (str(destination), key)).fetchone()
+        return bool(found)
+
+    def fresh(self, destination, messages) -> list:
+        """The messages whose content was not sent to `destination` yet, also dropping repeats within `messages`"""
+        result, keys = [], set()
+        for message in messages:
+            key = fingerprint(message)
+            if self.seen(destination, message) or (key is not None and key in keys):
+                continue
+            keys.add(key)
+            result.append(message)
+        return result
+
+    def add(self, destination, message) -> None:
+        """Record that the content of `message` was sent to `destination`"""
+        key = fingerprint(message)
+        if key is None:
+            return
+        self.bloom.add(self._key(destination, key))
+        self.db.execute('INSERT OR IGNORE INTO sent VALUES (?, ?)', (str(destination), key))
+        self.added += 1
+        if self.added % 100 == 0:
+            self.db.commit()
+
+    def flush(self) -> None:
+        self.db.commit()
+        if self.skipped:
+            logger.info(f'Deduplication saved {self.skipped} sends')
+
+
+# None unless DEDUP is enabled in .env
+dedup = DedupIndex(DEDUP_FILE, DEDUP_EXPECTED) if DEDUP else None
+if dedup:
+    atexit.register(dedup.flush)
@@ -0,0 +1,197 @@
+''' A simulated TelegramClient for offline benchmarks, serving synthetic channels. '''
+
+import asyncio
+import os
+import random
+from collections import Counter
+
+from telethon.errors.rpcerrorlist import ChatForwardsRestrictedError, FloodWaitError
+from telethon.tl.patched import Message, MessageService
+from telethon.tl.types import Channel, InputPeerChannel, InputPeerUser, MessageActionPinMessage, MessageMediaPhoto, PeerChannel, Photo
+
+from sessionpool import paced
+
+
+class FakeTelegramClient:
+    """
+    Serves synthetic channels and accepts sends without touching the network.
+
+    Every source chat holds `messages` messages with ids 1..messages. About 1%
+    are service messages, and every `album_every`-th message starts an album
+    of `album_size` photos. Messages are built page by page when they are
+    fetched, so a channel of a million messages costs nothing until it is read.
+
+    Every request waits `latency` seconds. Each method also has a server-side
+    budget of `server_rate` requests per second. Going over it causes a flood
+    wait for the time until the budget has recovered. On top of that, any
+    request gets a flood wait of `flood_seconds` with probability
+    `flood_probability`. As with sessionpool.Client, every flood wait of a
+    request paced by the rate limiter raises FloodWaitError; other requests
+    sleep through waits up to `flood_sleep_threshold` seconds inside the
+    request and raise longer ones.
+
+    With `restricted`, the source chats have forwarding restricted, so
+    their media has to be downloaded and uploaded again. Every photo is
+    `media_size` bytes, and each download or upload part also takes its size
+    divided by `bandwidth` seconds.
+    """
+
+    def __init__(self, messages: int, latency: float = 0.05, server_rate: float = 30,
+                 flood_probability: float = 0.0, flood_seconds: int = 30,
+                 flood_sleep_threshold: int = 60, album_every: int = 50, album_size: int = 4, seed: int = 0,
+                 restricted: bool = False, media_size: int = 256 * 1024, bandwidth: float = 2 * 1024 * 1024):
+        self.messages = messages
+        self.latency = latency
+        self.server_rate = server_rate
+        self.flood_probability = flood_probability
+        self.flood_seconds = flood_seconds
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.album_every = album_every
+        self.album_size = album_size
+        self.restricted = restricted
+        self.media_size = media_size
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.sent = Counter()
+        self._next_id = Counter()
+        self._budget = {}
+
+    # -- simulation ----------------------------------------------------------
+
+    async def _request(self, method: str) -> None:
+        """Account for one request of `method`: latency, server budget and flood waits"""
+        while True:
+            self.requests[method] += 1
+            await asyncio.sleep(self.latency)
+            seconds = self._flood_wait(method)
+            if not seconds:
+                return
+            self.flood_waits += 1
+            self.flood_wait_seconds += seconds
+            if paced.get() or seconds > self.flood_sleep_threshold:
+                raise FloodWaitError(request=None, capture=seconds)
+            await asyncio.sleep(seconds)
+
+    def _flood_wait(self, method: str) -> int:
+        """The flood wait this request gets (0 if it goes through)"""
+        now = asyncio.get_running_loop().time()
+        tokens, updated = self._budget.get(method, (self.server_rate, now))
+        tokens = min(self.server_rate, tokens + (now - updated) * self.server_rate)
+        if tokens < 1:
+            self._budget[method] = (tokens, now)
+            return int((1 - tokens) / self.server_rate) + 1
+        if self.flood_probability and self.random.random() < self.flood_probability:
+            self._budget[method] = (tokens, now)
+            return self.flood_seconds
+        self._budget[method] = (tokens - 1, now)
+        return 0
+
+    def _message(self, chat, message_id: int):
+        peer = PeerChannel(abs(hash(str(chat))) % 10**9)
+        if message_id % 100 == 0:
+            return MessageService(id=message_id, peer_id=peer, action=MessageActionPinMessage())
+        position = (message_id - 1) % self.album_every if self.album_every else self.album_size
+        if position < self.album_size:
+            photo = Photo(id=message_id, access_hash=0, file_reference=b'', date=None, sizes=[], dc_id=1)
+            return Message(id=message_id, peer_id=peer, message=f'photo {message_id}',
+                           media=MessageMediaPhoto(photo=photo), grouped_id=message_id - position)
+        return Message(id=message_id, peer_id=peer, message=f'message {message_id} of {chat}')
+
+    def _sent(self, entity, count: int) -> list:
+        self.sent[str(entity)] += count
+        first = self._next_id[str(entity)] + 1
+        self._next_id[str(entity)] += count
+        return [Message(id=i, peer_id=PeerChannel(1), message='') for i in range(first, first + count)]
+
+    # -- the TelegramClient methods the engines use ---------------------------
+
+    async def get_messages(self, chat, limit=100, offset_id=0, reverse=False, ids=None, **kwargs):
+        await self._request('get_messages')
+        if ids is not None:
+            return [self._message(chat, i) if 0 < i <= self.messages else None for i in ids]
+        if not reverse:
+            # Newest first, older than offset_id
+            last = min(offset_id - 1, self.messages) if offset_id else self.messages
+            return [self._message(chat, i) for i in range(last, max(0, last - (limit or 0)), -1)]
+        first = offset_id + 1
+        return [self._message(chat, i) for i in range(first, min(first + (limit or 0), self.messages + 1))]
+
+    async def iter_messages(self, chat, limit=None, offset_id=0, reverse=False, **kwargs):
+        while limit is None or limit > 0:
+            page = await self.get_messages(chat, limit=min(100, limit or 100), offset_id=offset_id, reverse=True)
+            if not page:
+                return
+            for message in page:
+                yield message
+            offset_id = page[-1].id
+            if limit is not None:
+                limit -= len(page)
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._request('send_message')
+        return self._sent(entity, 1)[0]
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        await self._request('forward_messages')
+        if self.restricted:
+            raise ChatForwardsRestrictedError(request=None)
+        if not isinstance(messages, list):
+            return self._sent(entity, 1)[0]
+        return self._sent(entity, len(messages))
+
+    async def send_file(self, entity, file, **kwargs):
+        await self._request('send_file')
+        if isinstance(file, list):
+            return self._sent(entity, len(file))
+        return self._sent(entity, 1)[0]
+
+    async def get_entity(self, entity):
+        await self._request('get_entity')
+        return Channel(id=abs(hash(str(entity))) % 10**9, title=str(entity), photo=None, date=None,
+                       noforwards=self.restricted)
+
+    async def download_media(self, message, file=None, **kwargs):
+        await self._request('download_media')
+        await asyncio.sleep(self.media_size / self.bandwidth)
+        photo = (message.media if isinstance(message, Message) else message).photo
+        if os.path.isdir(file):
+            file = os.path.join(file, f'photo_{photo.id}.jpg')
+        with open(file, 'wb') as out:
+            out.write(f'media of {photo.id}'.encode().ljust(self.media_size, b'.'))
+        return file
+
+    async def __call__(self, request):
+        # Only the upload parts of transfer.upload are sent as raw requests
+        await self._request(type(request).__name__)
+        await asyncio.sleep(len(request.bytes) / self.bandwidth)
+        return True
+
+    async def get_me(self, input_peer=False):
+        return InputPeerUser(user_id=1, access_hash=0)
+
+    async def get_input_entity(self, peer):
+        await self._request('get_input_entity')
+        return InputPeerChannel(channel_id=abs(hash(str(peer))) % 10**9, access_hash=0)
+
+    async def get_peer_id(self, peer):
+        return peer
+
+    def is_connected(self) -> bool:
+        return True
+
+
+class FakePool:
+    """Stands in for sessionpool.SessionPool with a single fake account"""
+
+    def __init__(self, client):
+        self.clients = [client]
+        self.main = client
+
+    async def acquire(self):
+        return self.main
+
+    def release(self, client) -> None:
+        pass
@@ -0,0 +1,166 @@
+''' Per-section message filters from config.ini, applied by Telegram where it can and on each fetched page otherwise. '''
+
+import datetime
+import logging
+import re
+
+from telethon import utils
+from telethon.tl.types import (
+    InputMessagesFilterDocument, InputMessagesFilterGif, InputMessagesFilterMusic, InputMessagesFilterPhotos,
+    InputMessagesFilterPhotoVideo, InputMessagesFilterRoundVideo, InputMessagesFilterRoundVoice,
+    InputMessagesFilterUrl, InputMessagesFilterVideo, InputMessagesFilterVoice, MessageEntityTextUrl,
+    MessageEntityUrl)
+
+from settings import configur
+from peers import resolve
+
+logger = logging.getLogger(__name__)
+
+KEYS = ('media', 'search', 'sender', 'regex', 'min_id', 'max_id', 'min_date', 'max_date')
+
+# The `media` values Telegram can filter on itself; any other set is checked on each message
+SERVER_MEDIA = {
+    frozenset({'photo'}): InputMessagesFilterPhotos,
+    frozenset({'video'}): InputMessagesFilterVideo,
+    frozenset({'photo', 'video'}): InputMessagesFilterPhotoVideo,
+    frozenset({'gif'}): InputMessagesFilterGif,
+    frozenset({'round'}): InputMessagesFilterRoundVideo,
+    frozenset({'voice'}): InputMessagesFilterVoice,
+    frozenset({'round', 'voice'}): InputMessagesFilterRoundVoice,
+    frozenset({'audio'}): InputMessagesFilterMusic,
+    frozenset({'document'}): InputMessagesFilterDocument,
+    frozenset({'url'}): InputMessagesFilterUrl,
+}
+MEDIA = {'photo', 'video', 'gif', 'round', 'voice', 'audio', 'sticker', 'document', 'text', 'url'}
+
+
+def media_kinds(message) -> set:
+    """The `media` values `message` matches: the kind of its file ('text' if none), plus 'url' if it has a link"""
+    if message.photo:
+        kinds = {'photo'}
+    elif message.gif:
+        kinds = {'gif'}
+    elif message.video_note:
+        kinds = {'round'}
+    elif message.video:
+        kinds = {'video'}
+    elif message.voice:
+        kinds = {'voice'}
+    elif message.audio:
+        kinds = {'audio'}
+    elif message.sticker:
+        kinds = {'sticker'}
+    elif message.document:
+        kinds = {'document'}
+    else:
+        kinds = {'text'}
+    if message.web_preview or any(isinstance(e, (MessageEntityUrl, MessageEntityTextUrl)) for e in message.entities or ()):
+        kinds.add('url')
+    return kinds
+
+
+def _date(value: str):
+    if not value:
+        return None
+    date = datetime.datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=datetime.timezone.utc)
+
+
+class Filter:
+    """
+    The messages one config.ini section sends, from its optional filter keys.
+
+    What Telegram can filter goes into the history requests (one media
+    filter, the search text, the sender and `max_id`), so the rest of the
+    chat is never fetched. `min_id` and `min_date` move the start of the
+    fetch. The rest (other media sets, the dates, the regex) is compiled
+    here once and checked on every fetched page before it is queued.
+    History comes oldest first, so the fetch stops at `max_date`.
+    """
+
+    def __init__(self, options: dict):
+        self.key = tuple(options.get(key, '') for key in KEYS)
+        self.media = {kind.strip().lower() for kind in options.get('media', '').split(',') if kind.strip()}
+        if self.media - MEDIA:
+            raise ValueError(f'unknown media {", ".join(sorted(self.media - MEDIA))}; use {", ".join(sorted(MEDIA))}')
+        self.server_media = SERVER_MEDIA.get(frozenset(self.media))
+        self.search = options.get('search') or None
+        self.sender = options.get('sender') or None
+        self.sender_id = None
+        self.regex = re.compile(options['regex']) if options.get('regex') else None
+        self.min_id = int(options.get('min_id') or 0)
+        self.max_id = int(options.get('max_id') or 0)
+        self.min_date = _date(options.get('min_date'))
+        self.max_date = _date(options.get('max_date'))
+
+    @property
+    def server_only(self) -> bool:
+        """True if Telegram applies every filter itself, so it can count the matching messages"""
+        return not (self.regex or self.max_date or (self.media and not self.server_media))
+
+    async def params(self, client) -> dict:
+        """The iter_messages arguments that let Telegram do the filtering"""
+        params = {}
+        if self.server_media:
+            params['filter'] = self.server_media()
+        if self.search:
+            params['search'] = self.search
+        if self.sender:
+            peer = await resolve(client, self.sender)
+            self.sender_id = utils.get_peer_id(peer)
+            params['from_user'] = peer
+        if self.max_id:
+            params['max_id'] = self.max_id + 1  # Telethon excludes max_id itself
+        return params
+
+    async def start(self, client, chat, offset: int) -> int:
+        """`offset` moved up to just before `min_id` and `min_date`"""
+        offset = max(offset, self.min_id - 1)
+        if self.min_date:
+            # The newest message before min_date; one request instead of fetching everything older
+            before = await client.get_messages(chat, limit=1, offset_date=self.min_date)
+            if before:
+                offset = max(offset, before[0].id)
+        return offset
+
+    def matches(self, message, everything: bool = False) -> bool:
+        """
+        Whether `message` passes the filters Telegram does not apply, or
+        every filter with `everything` (for messages fetched by id).
+        """
+        if self.min_date and message.date < self.min_date:
+            return False
+        if self.max_date and message.date >= self.max_date:
+            return False
+        if self.regex and not self.regex.search(message.message or ''):
+            return False
+        if self.media and (everything or not self.server_media) and not self.media & media_kinds(message):
+            return False
+        if everything:
+            if self.search and self.search.casefold() not in (message.message or '').casefold():
+                return False
+            if self.sender_id is not None and message.sender_id != self.sender_id:
+                return False
+            if message.id < self.min_id or (self.max_id and message.id > self.max_id):
+                return False
+        return True
+
+    def done(self, message) -> bool:
+        """True once the history has passed `max_date`, so nothing later can match"""
+        return bool(self.max_date and message.date >= self.max_date)
+
+
+_filters = {}
+
+
+def section_filter(forward: str):
+    """The Filter of a config.ini section, or None if it has no filter keys"""
+    if forward not in _filters:
+        options = {key: configur.get(forward, key) for key in KEYS if configur.get(forward, key, fallback='')}
+        try:
+            _filters[forward] = Filter(options) if options else None
+        except Exception as err:
+            logging.exception('The filters of %s are not valid. See the README.md file for more details. \n\n %s',
+                              forward, str(err))
+            quit()
+    return _filters[forward]
@@ -0,0 +1,75 @@
+''' A persistent ledger of every FloodWaitError, used to resume deferred sections on time. '''
+
+import contextvars
+import os
+import sqlite3
+import sys
+import time
+
+from settings import CHECKPOINT_FILE
+
+# The config.ini section the current task is forwarding (set by the scheduler)
+current_pair = contextvars.ContextVar('current_pair', default=None)
+
+SCRIPT = os.path.basename(sys.argv[0])
+
+_db = sqlite3.connect(CHECKPOINT_FILE)
+_db.execute(
+    'CREATE TABLE IF NOT EXISTS flood_waits ('
+    'id INTEGER PRIMARY KEY, account TEXT NOT NULL, method TEXT NOT NULL, pair TEXT, script TEXT NOT NULL, '
+    'seconds INTEGER NOT NULL, deadline REAL NOT NULL, recorded REAL NOT NULL, '
+    'deferred INTEGER NOT NULL DEFAULT 0, resumed INTEGER NOT NULL DEFAULT 0)'
+)
+_db.commit()
+
+
+class FloodDeferred(Exception):
+    """The flood wait of a section is too long to sit out; the section is queued for later"""
+
+    def __init__(self, seconds: int, method: str = None):
+        super().__init__(f'flood wait of {seconds} seconds, resuming later')
+        self.seconds = seconds
+        self.method = method
+        self.deadline = time.time() + seconds
+
+
+def record(account: str, method: str, seconds: int, deferred: bool = False) -> None:
+    """
+    Write a FloodWaitError to the ledger.
+
+    `deferred` entries mark a section that stopped instead of waiting;
+    check_flood_wait.py resumes those once their deadline has passed.
+    """
+    now = time.time()
+    with _db:
+        _db.execute(
+            'INSERT INTO flood_waits (account, method, pair, script, seconds, deadline, recorded, deferred) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (account, method, current_pair.get(), SCRIPT, seconds, now + seconds, now, int(deferred))
+        )
+
+
+def pending() -> list:
+    """Deferred entries that have not been resumed yet, earliest deadline first"""
+    return _db.execute(
+        'SELECT id, account, method, pair, script, deadline FROM flood_waits '
+        'WHERE deferred = 1 AND resumed = 0 ORDER BY deadline'
+    ).fetchall()
+
+
+def account_deadline(account: str) -> float:
+    """The latest deadline recorded for `account` (0 if it was never flood-waited)"""
+    row = _db.execute('SELECT MAX(deadline) FROM flood_waits WHERE account = ?', (account,)).fetchone()
+    return row[0] or 0
+
+
+def longest(account: str, method: str) -> int:
+    """The longest flood wait recorded for `method` on `account` (0 if none)"""
+    row = _db.execute('SELECT MAX(seconds) FROM flood_waits WHERE account = ? AND method = ?',
+                      (account, method)).fetchone()
+    return row[0] or 0
+
+
+def mark_resumed(ids) -> None:
+    with _db:
+        _db.executemany('UPDATE flood_waits SET resumed = 1 WHERE id = ?', [(i,) for i in ids])
@@ -1,13 +1,27 @@
 ''' A script to send all messages from one chat to another. '''
 
+import argparse
 import asyncio
 import logging
 
-from telethon.tl.patched import MessageService
 from telethon.errors.rpcerrorlist import FloodWaitError
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from settings import API_ID, API_HASH, forwards, get_forward, update_offset, STRING_SESSION
+from telethon.tl.types import DocumentAttributeFilename
+from settings import API_ID, API_HASH, forwards, get_forward, update_offset, checkpoints, saved_config
+from scheduler import fairness, run_pairs
+from daemon import run_daemon
+from dedup import dedup
+import metrics
+import memory
+from sessionpool import SessionPool, account_of, build_sessions
+from pipeline import prefetch_messages, iter_chunks, as_message
+from strategy import deliver, protected
+from transfer import pipeline
+from peers import preflight, resolve
+from filters import section_filter
+from sync import run_sync
+from planner import plan_job
+from ratelimit import RateLimiter
+from shutdown import Shutdown, resume, stopping
 
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,21 +29,34 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 SENT_VIA = f'\n__Sent via__ `{str(__file__)}`'
 
+CONFIG = {
+    'BATCH_SIZE': 100,  # Messages per forward request (Telegram allows at most 100)
+}
 
-def intify(string):
-    try:
-        return int(string)
-    except:
-        return string
+# Starts at 10 requests per second and adapts to the flood waits Telegram returns
+limiter = RateLimiter(initial_rate=10)
+
+
+async def safe_forward(client, entity, from_peer, messages):
+    """Safely forward a list of messages of `from_peer` server-side, without the "Forwarded from" header, with flood wait handling"""
+    ids = [m.id for m in messages]
+    while True:
+        try:
+            return await limiter.call(lambda: client.forward_messages(entity, ids, from_peer=from_peer, drop_author=True), entity, 'forward_messages', account_of(client))
+        except FloodWaitError as fwe:
+            logging.warning(f'Flood wait for forwarding messages: {fwe.seconds} seconds')
+            metrics.retry('forward_messages')
+            await asyncio.sleep(fwe.seconds)
 
 
 async def safe_send_file(client, entity, file, **kwargs):
     """Safely send a file with flood wait handling"""
     while True:
         try:
-            return await client.send_file(entity, file, **kwargs)
+            return await limiter.call(lambda: client.send_file(entity, file, **kwargs), entity, 'send_file', account_of(client))
         except FloodWaitError as fwe:
             logging.warning(f'Flood wait for sending file: {fwe.seconds} seconds')
+            metrics.retry('send_file')
             await asyncio.sleep(fwe.seconds)
 
 
@@ -37,18 +64,96 @@ async def safe_send_message(client, entity, message, **kwargs):
     """Safely send a message with flood wait handling"""
     while True:
         try:
-            return await client.send_message(entity, message, **kwargs)
+            return await limiter.call(lambda: client.send_message(entity, message, **kwargs), entity, 'send_message', account_of(client))
         except FloodWaitError as fwe:
             logging.warning(f'Flood wait for sending message: {fwe.seconds} seconds')
+            metrics.retry('send_message')
             await asyncio.sleep(fwe.seconds)
 
 
-async def forward_job():
+async def safe_send_album(client, entity, album, **kwargs):
+    """Safely send an album (messages sharing a grouped_id) as one media group"""
+    return await safe_send_file(
+        client, entity, [m.media for m in album],
+        caption=[m.message or '' for m in album],
+        formatting_entities=[m.entities or [] for m in album], **kwargs)
+
+
+async def safe_send_copy(client, from_peer, entity, album, reply_to=None):
+    """Safely send a copy of a message or album, re-uploading protected media through the media pipeline"""
+    if not protected(from_peer, album):
+        if len(album) == 1:
+            return await safe_send_message(client, entity, as_message(album[0]), reply_to=reply_to)
+        return await safe_send_album(client, entity, album, reply_to=reply_to)
+    media = await pipeline.media(client, album)
+    if len(album) > 1:
+        return await safe_send_file(client, entity, media, caption=[m.message or '' for m in album],
+                                    formatting_entities=[m.entities or [] for m in album], reply_to=reply_to)
+    if media[0] is None:
+        return await safe_send_message(client, entity, album[0].message, formatting_entities=album[0].entities,
+                                       reply_to=reply_to)
+    return await safe_send_file(client, entity, media[0], caption=album[0].message or '',
+                                formatting_entities=album[0].entities, reply_to=reply_to)
+
+
+async def forward_pair(client, forward):
+    ''' forward the new messages of one config.ini section and return its offset report '''
+    from_chat, to_chat, offset = get_forward(forward)
+
+    if not offset:
+        offset = 0
+
+    from_peer, to_peer = await resolve(client, from_chat), await resolve(client, to_chat)
+    # A send the last run could not confirm is looked up in the destination first
+    offset = await resume(client, forward, from_peer, to_peer, offset)
+    initial_offset = offset
+    last_id = 0
+    error_occured = False
+
+    messages = prefetch_messages(client, from_peer, offset, spec=section_filter(forward))
+    async for chunk in iter_chunks(messages, CONFIG['BATCH_SIZE']):
+        try:
+            fresh = dedup.fresh(to_chat, chunk) if dedup else chunk
+            if len(fresh) < len(chunk):
+                metrics.log_message(logging, 'skipping %s messages, already sent to %s', len(chunk) - len(fresh), to_chat)
+                metrics.count(forward, 'skipped', len(chunk) - len(fresh))
+            if fresh:
+                checkpoints.begin(forward, fresh[0].id, fresh[-1].id)
+            # Server-side forward where the chat allows it, a copy otherwise
+            await deliver(client, from_peer, forward, fresh,
+                          lambda batch: safe_forward(client, to_peer, from_peer, batch),
+                          lambda album, reply_to: safe_send_copy(client, from_peer, to_peer, album, reply_to),
+                          lambda album: pipeline.prepare(client, album))
+            if fresh:
+                metrics.log_message(logging, 'forwarding messages up to id = %s', fresh[-1].id)
+                metrics.count(forward, 'forwarded', len(fresh))
+            if dedup:
+                for m in fresh:
+                    dedup.add(to_chat, m)
+            last_id = str(chunk[-1].id)
+            update_offset(forward, last_id)
+            checkpoints.confirm(forward)
+        except Exception as err:
+            logging.exception(err)
+            metrics.count(forward, 'failed')
+            error_occured = True
+            break
+
+    logging.info('Completed working with %s', forward)
+    # Record final offset for this mapping (last_id if forwarded, else initial)
+    final_offset = last_id if last_id else str(initial_offset)
+    return {
+        'from': from_chat,
+        'to': to_chat,
+        'final_offset': final_offset,
+        'error': error_occured
+    }
+
+
+async def forward_job(daemon: bool = False, sync: bool = False):
     ''' the function that does the job 😂 '''
-    if STRING_SESSION:
-        session = StringSession(STRING_SESSION)
-    else:
-        session = 'forwarder'
+    # One session per account; several accounts share the sections between them
+    sessions = build_sessions()
 
     # Ensure API_ID and API_HASH are not None (assertion already in settings.py)
     assert API_ID is not None and API_HASH is not None, "API_ID and API_HASH must be set in .env file"
@@ -57,7 +162,8 @@ async def forward_job():
     api_id = int(API_ID)
     api_hash = str(API_HASH)
 
-    async with TelegramClient(session, api_id, api_hash) as client:
+    async with SessionPool(sessions, api_id, api_hash) as pool, metrics.Exporter(), memory.Monitor(pool):
+        client = pool.main
 
         confirm = ''' IMPORTANT 🛑
             Are you sure that your `config.ini` is correct ?
@@ -69,48 +175,26 @@ async def forward_job():
 
         input(confirm)
 
-        error_occured = False
-        offset_reports = []  # Collect per-forward final offsets for summary
-        for forward in forwards:
-            from_chat, to_chat, offset = get_forward(forward)
-
-            if not offset:
-                offset = 0
-
-            initial_offset = offset
-            last_id = 0
-
-            async for message in client.iter_messages(intify(from_chat), reverse=True, offset_id=offset):
-                if isinstance(message, MessageService):
-                    continue
-                try:
-                    await safe_send_message(client, intify(to_chat), message)
-                    last_id = str(message.id)
-                    logging.info('forwarding message with id = %s', last_id)
-                    update_offset(forward, last_id)
-                    
-                    # Add a small delay to avoid hitting rate limits
-                    await asyncio.sleep(0.1)
-                except FloodWaitError as fwe:
-                    logging.warning(f'Flood wait: {fwe.seconds} seconds')
-                    await asyncio.sleep(fwe.seconds)
-                except Exception as err:
-                    logging.exception(err)
-                    error_occured = True
-                    break
-
-            logging.info('Completed working with %s', forward)
-            # Record final offset for this mapping (last_id if forwarded, else initial)
-            final_offset = last_id if last_id else str(initial_offset)
-            offset_reports.append({
-                'from': from_chat,
-                'to': to_chat,
-                'final_offset': final_offset
-            })
-
-        # Send config file with flood wait handling
+        await preflight(pool, forwards)
+        async with Shutdown():
+            offset_reports = await run_pairs(forwards, forward_pair, pool)
+        if stopping():
+            limiter.save()
+            return
+        error_occured = any(r['error'] for r in offset_reports)
+        # Apply the source edits and deletions since the last run to what was sent
+        if sync:
+            await run_sync(pool, forwards)
+        limiter.save()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
+
+        # Send config.ini with the saved offsets, with flood wait handling
         try:
-            await safe_send_file(client, 'me', 'config.ini', caption='This is your config file for telegram-chat-forward.')
+            await safe_send_file(client, 'me', saved_config(), attributes=[DocumentAttributeFilename('config.ini')],
+                                 force_document=True,
+                                 caption='This is your config file for telegram-chat-forward, with the saved offsets.')
         except Exception as err:
             logging.error(f'Failed to send config file: {err}')
 
@@ -121,11 +205,16 @@ async def forward_job():
         else:
             lines = [f"- {r['from']} → {r['to']}: {r['final_offset']}" for r in offset_reports]
             offset_summary_text = "Your offset numbers:\n" + "\n".join(lines)
+            # How the sections shared the accounts
+            share_lines = fairness(forwards)
+            for line in share_lines:
+                logging.info(line)
+            offset_summary_text += "\n\nSections:\n" + "\n".join(share_lines)
 
         final_message = f'''Hi !
         \n**{message}**
         \n{offset_summary_text}
-        \nTo resume later, edit the corresponding offset in config.ini to this number.
+        \nThe offsets are saved in checkpoints.db, and the next run resumes from them. The config.ini above has them too, to resume on another machine. To start a section from another message, change its offset in config.ini.
         \n**Telegram All Forward** is developed by OpenSource Dev.
         \nPlease star 🌟 on [GitHub](https://github.com/its-anya/telegram-all-forward.git).
         {SENT_VIA}'''
@@ -135,6 +224,21 @@ async def forward_job():
         except Exception as err:
             logging.error(f'Failed to send final message: {err}')
 
+        # Keep forwarding new messages as they arrive
+        if daemon:
+            async with Shutdown():
+                await run_daemon(pool, forwards, forward_pair)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--daemon', action='store_true', help='keep running and forward new messages as they arrive')
+    parser.add_argument('--sync', action='store_true', help='also apply source edits and deletions since the last run')
+    parser.add_argument('--plan', action='store_true', help='only estimate messages, requests and time per section')
+    args = parser.parse_args()
+
     assert forwards
-    asyncio.run(forward_job())
+    if args.plan:
+        asyncio.run(plan_job(limiter, CONFIG['BATCH_SIZE']))
+    else:
+        asyncio.run(forward_job(daemon=args.daemon, sync=args.sync))
@@ -0,0 +1,112 @@
+''' Keep long runs at a flat memory footprint: trim Telethon's entity caches and report RSS over time. '''
+
+import asyncio
+import logging
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows: RSS is not reported
+
+from telethon import utils
+from telethon.sessions import MemorySession
+
+from settings import MEMORY_INTERVAL
+import metrics
+import peers
+
+logger = logging.getLogger(__name__)
+
+
+def rss_mb():
+    """The resident memory of this process in MB (the peak, where the current size is not available), or None"""
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """The peak resident memory of this process in MB, or None"""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 1024)
+
+
+def trim_entities(client) -> int:
+    """
+    Forget every entity `client` has cached except itself and the configured chats.
+
+    Telethon remembers the access hash of every user and chat it sees, in the
+    client's update cache and, with a StringSession, in memory. Over a long
+    history that is every sender. The configured chats stay, since updates
+    (--daemon) need them, and peers.py has their input peers anyway. Returns
+    how many entities were dropped. Both caches are Telethon internals, so a
+    version without them is left alone.
+    """
+    cache = getattr(client, '_mb_entity_cache', None)
+    if cache is None or not hasattr(cache, 'retain'):
+        return 0
+    keep = set()
+    for peer in peers.cache.memory.values():
+        try:
+            keep.add(utils.resolve_id(utils.get_peer_id(peer))[0])
+        except TypeError:
+            pass  # InputPeerSelf ('me'), kept below as the self id
+    keep.add(cache.self_id)
+    before = len(cache)
+    cache.retain(lambda entity_id: entity_id in keep)
+    dropped = before - len(cache)
+    session = client.session
+    if isinstance(session, MemorySession) and isinstance(getattr(session, '_entities', None), set):
+        before = len(session._entities)
+        # Rows are (marked id, access hash, username, phone, name)
+        session._entities = {row for row in session._entities if utils.resolve_id(row[0])[0] in keep}
+        dropped += before - len(session._entities)
+    return dropped
+
+
+class Monitor:
+    """
+    While open, trims the entity caches of the pool's clients and logs RSS every MEMORY_INTERVAL seconds.
+
+    RSS also goes to the metrics (see metrics.py) as a gauge, with its
+    history over the run, and the peak is logged on exit.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.peak = 0.0
+
+    def sample(self):
+        rss = rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+            metrics.record_rss(rss)
+        return rss
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(MEMORY_INTERVAL)
+            dropped = sum(trim_entities(client) for client in self.pool.clients)
+            rss = self.sample()
+            if rss is None:
+                logger.info(f'Memory: {dropped} cached entities trimmed')
+            else:
+                logger.info(f'Memory: {rss:.1f} MB RSS (peak {self.peak:.1f} MB), {dropped} cached entities trimmed')
+
+    async def __aenter__(self):
+        self.sample()
+        self.task = asyncio.create_task(self._run()) if MEMORY_INTERVAL else None
+        return self
+
+    async def __aexit__(self, *args):
+        if self.task:
+            self.task.cancel()
+        if self.sample() is not None:
+            logger.info(f'Peak memory: {self.peak:.1f} MB RSS')
@@ -0,0 +1,175 @@
+''' Counters, latency histograms and trace spans for the forwarding hot path. '''
+
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import time
+from collections import defaultdict, deque
+
+from settings import METRICS_FILE, METRICS_INTERVAL, METRICS_PORT, TRACE_FILE, MESSAGE_LOG_EVERY
+from floodledger import current_pair
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the request latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+pair_counters = defaultdict(lambda: defaultdict(int))   # section -> name -> count
+latency = defaultdict(lambda: [0] * len(BUCKETS))       # method -> count per bucket
+latency_sum = defaultdict(float)                        # method -> total seconds
+flood_wait_seconds = defaultdict(int)                   # method -> seconds
+retries = defaultdict(int)                              # operation -> retries
+queue_depth = {}                                        # chat -> pages prefetched
+rss = deque(maxlen=1000)                                # (time, MB) samples, oldest first
+
+_message_count = itertools.count(1)
+_trace = open(TRACE_FILE, 'a') if TRACE_FILE else None
+
+
+def _now() -> float:
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
+def count(section: str, name: str, value: int = 1) -> None:
+    """Add `value` to the `name` counter of a section (forwarded, skipped, failed, ...)"""
+    pair_counters[section][name] += value
+
+
+def flood(method: str, seconds: int) -> None:
+    flood_wait_seconds[method] += seconds
+
+
+def retry(operation: str) -> None:
+    retries[operation] += 1
+
+
+def set_queue_depth(chat, pages: int) -> None:
+    queue_depth[str(chat)] = pages
+
+
+def record_rss(megabytes: float) -> None:
+    rss.append((round(time.time()), round(megabytes, 1)))
+
+
+@contextlib.contextmanager
+def timed(method: str, **attributes):
+    """Record the latency of one request in its method's histogram, and as a trace span if TRACE_FILE is set"""
+    start = _now()
+    error = None
+    try:
+        yield
+    except BaseException as err:
+        error = type(err).__name__
+        raise
+    finally:
+        duration = _now() - start
+        latency[method][next(i for i, bound in enumerate(BUCKETS) if duration <= bound)] += 1
+        latency_sum[method] += duration
+        if _trace:
+            span = {'name': method, 'pair': current_pair.get(), 'start': time.time() - duration,
+                    'duration': round(duration, 6), 'error': error, **{k: str(v) for k, v in attributes.items()}}
+            _trace.write(json.dumps(span) + '\n')
+
+
+def log_message(log, text: str, *args) -> None:
+    """Log a per-message line at INFO, but only every MESSAGE_LOG_EVERY-th one (never when it is 0)"""
+    if MESSAGE_LOG_EVERY and next(_message_count) % MESSAGE_LOG_EVERY == 0:
+        log.info(text, *args)
+
+
+def snapshot() -> dict:
+    """All metrics as a JSON-friendly dict"""
+    return {
+        'time': time.time(),
+        'pairs': {section: dict(counters) for section, counters in pair_counters.items()},
+        'latency': {
+            method: {
+                'count': sum(counts),
+                'sum': round(latency_sum[method], 3),
+                'buckets': {str(bound): c for bound, c in zip(BUCKETS, itertools.accumulate(counts))},
+            } for method, counts in latency.items()
+        },
+        'flood_wait_seconds': dict(flood_wait_seconds),
+        'retries': dict(retries),
+        'queue_depth': dict(queue_depth),
+        'rss_mb': list(rss),
+    }
+
+
+def prometheus() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = ['# TYPE forward_pair_total counter']
+    for section, counters in pair_counters.items():
+        for name, value in counters.items():
+            lines.append(f'forward_pair_total{{pair="{section}",kind="{name}"}} {value}')
+    lines.append('# TYPE forward_request_seconds histogram')
+    for method, counts in latency.items():
+        for bound, cumulative in zip(BUCKETS, itertools.accumulate(counts)):
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f'forward_request_seconds_bucket{{method="{method}",le="{le}"}} {cumulative}')
+        lines.append(f'forward_request_seconds_sum{{method="{method}"}} {latency_sum[method]:.6f}')
+        lines.append(f'forward_request_seconds_count{{method="{method}"}} {sum(counts)}')
+    lines.append('# TYPE forward_flood_wait_seconds_total counter')
+    for method, seconds in flood_wait_seconds.items():
+        lines.append(f'forward_flood_wait_seconds_total{{method="{method}"}} {seconds}')
+    lines.append('# TYPE forward_retries_total counter')
+    for operation, value in retries.items():
+        lines.append(f'forward_retries_total{{operation="{operation}"}} {value}')
+    lines.append('# TYPE forward_queue_depth gauge')
+    for chat, pages in queue_depth.items():
+        lines.append(f'forward_queue_depth{{chat="{chat}"}} {pages}')
+    if rss:
+        lines.append('# TYPE forward_resident_memory_megabytes gauge')
+        lines.append(f'forward_resident_memory_megabytes {rss[-1][1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot() -> None:
+    if not METRICS_FILE:
+        return
+    try:
+        with open(METRICS_FILE, 'w') as out:
+            json.dump(snapshot(), out, indent=2)
+    except Exception as err:
+        logger.warning(f'Could not write metrics to {METRICS_FILE}: {err}')
+    if _trace:
+        _trace.flush()
+
+
+async def _serve(reader, writer):
+    await reader.readline()
+    body = prometheus().encode()
+    writer.write(
+        b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+        b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+    await writer.drain()
+    writer.close()
+
+
+async def _write_periodically():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        write_snapshot()
+
+
+class Exporter:
+    """Serves /metrics on METRICS_PORT and writes METRICS_FILE every METRICS_INTERVAL seconds while open"""
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(_serve, port=METRICS_PORT) if METRICS_PORT else None
+        self.writer = asyncio.create_task(_write_periodically()) if METRICS_FILE else None
+        if self.server:
+            logger.info(f'Metrics served on http://localhost:{METRICS_PORT}/metrics')
+        return self
+
+    async def __aexit__(self, *args):
+        if self.writer:
+            self.writer.cancel()
+        if self.server:
+            self.server.close()
+        write_snapshot()
@@ -0,0 +1,110 @@
+''' Resolve the config.ini chats to input peers once, check access, and cache them across runs. '''
+
+import logging
+import sqlite3
+import time
+
+from telethon.extensions import BinaryReader
+from telethon.tl.types import Channel
+
+from settings import CHECKPOINT_FILE, PEER_CACHE_TTL, get_forward
+
+logger = logging.getLogger(__name__)
+
+
+def intify(string):
+    """Convert string to int if possible, otherwise return as is"""
+    try:
+        return int(string)
+    except ValueError:
+        return string
+
+
+class PeerCache:
+    """
+    Input peers of the configured chats, per account, stored next to the offsets.
+
+    Resolving a username or t.me link costs a heavily rate-limited
+    ResolveUsername request, so each chat is resolved once and the input peer
+    (id and access hash) is reused by every run for PEER_CACHE_TTL seconds.
+    Access hashes belong to one account, so entries are keyed by its user id.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS peers (account INTEGER NOT NULL, chat TEXT NOT NULL, '
+            'peer BLOB NOT NULL, resolved REAL NOT NULL, PRIMARY KEY (account, chat))'
+        )
+        self.db.commit()
+        self.memory = {}
+        self.accounts = {}
+
+    async def _account(self, client) -> int:
+        if id(client) not in self.accounts:
+            me = await client.get_me(input_peer=True)
+            self.accounts[id(client)] = me.user_id
+        return self.accounts[id(client)]
+
+    async def resolve(self, client, chat):
+        """The input peer of `chat` (an id, @username or t.me link from config.ini) for `client`"""
+        account = await self._account(client)
+        key = (account, str(chat))
+        if key in self.memory:
+            return self.memory[key]
+        row = self.db.execute('SELECT peer, resolved FROM peers WHERE account = ? AND chat = ?', key).fetchone()
+        if row and time.time() - row[1] < self.ttl:
+            peer = BinaryReader(row[0]).tgread_object()
+        else:
+            peer = await client.get_input_entity(intify(chat))
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO peers VALUES (?, ?, ?, ?)',
+                                (account, str(chat), bytes(peer), time.time()))
+        self.memory[key] = peer
+        return peer
+
+
+cache = PeerCache(CHECKPOINT_FILE, PEER_CACHE_TTL)
+resolve = cache.resolve
+
+
+async def _check(client, forward: str, sources: bool) -> list:
+    """The problems with the `from` (if `sources`) and `to` chats of one section for `client` (empty if none)"""
+    from_chat, to_chat, _ = get_forward(forward)
+    problems = []
+    try:
+        if sources:
+            await client.get_messages(await resolve(client, from_chat), limit=1)
+    except Exception as err:
+        problems.append(f'cannot read `from` = {from_chat}: {err}')
+    try:
+        peer = await resolve(client, to_chat)
+        entity = await client.get_entity(peer)
+        if isinstance(entity, Channel):
+            if entity.left:
+                problems.append(f'not a member of `to` = {to_chat}')
+            elif entity.broadcast and not (entity.creator or (entity.admin_rights and entity.admin_rights.post_messages)):
+                problems.append(f'cannot post in channel `to` = {to_chat}')
+    except Exception as err:
+        problems.append(f'cannot resolve `to` = {to_chat}: {err}')
+    return problems
+
+
+async def preflight(pool, forwards, sources: bool = True) -> None:
+    """
+    Resolve and check every `from` and `to` chat for every account before sending anything.
+
+    A section can run on any account, so each account has to reach all of
+    them. The problems of all sections are logged together and the script
+    stops, instead of failing one section at a time mid-run. With `sources`
+    off, only the destinations are checked.
+    """
+    problems = []
+    for client in pool.clients:
+        for forward in forwards:
+            problems.extend(f'[{forward}] {problem}' for problem in await _check(client, forward, sources))
+    if problems:
+        logging.error('Some chats in config.ini cannot be used:\n%s', '\n'.join(problems))
+        quit()
+    logger.info(f'Resolved and checked the chats of {len(forwards)} section(s)')
@@ -0,0 +1,333 @@
+''' Fetch chat history ahead of the sender through a bounded queue. '''
+
+import asyncio
+import collections
+import contextlib
+import logging
+
+from telethon import utils
+from telethon.tl.patched import Message, MessageService
+from telethon.tl.types import InputPeerChannel
+
+from settings import FETCH_SHARDS, PAGE_SIZE, PREFETCH_PAGES
+from floodledger import current_pair
+import metrics
+from shutdown import stopping
+
+logger = logging.getLogger(__name__)
+
+
+class Record:
+    """
+    The fields of a message that the engines send, without the rest of the Telethon object.
+
+    A Message keeps its client, its sender and chat entities and every TL
+    field. A Record keeps only what forwarding, copying and deduplication
+    use, in __slots__, so queued pages of a long history stay small.
+    Service messages are never turned into records.
+    """
+
+    __slots__ = ('id', 'grouped_id', 'message', 'entities', 'media', 'noforwards', 'silent', 'reply_markup',
+                 'reply_to_msg_id')
+
+    def __init__(self, message):
+        self.id = message.id
+        self.grouped_id = message.grouped_id
+        self.message = message.message
+        self.entities = message.entities
+        self.media = message.media
+        self.noforwards = message.noforwards
+        self.silent = message.silent
+        self.reply_markup = message.reply_markup
+        self.reply_to_msg_id = reply_id(message)
+
+
+def reply_id(message):
+    """The id of the message `message` replies to in its own chat, or None (no reply, a story, another chat)"""
+    if isinstance(message, Record):
+        return message.reply_to_msg_id
+    reply_to = message.reply_to
+    if reply_to is None or getattr(reply_to, 'reply_to_peer_id', None):
+        return None
+    return getattr(reply_to, 'reply_to_msg_id', None)
+
+
+def as_message(message):
+    """A Telethon Message to pass to send_message(entity, message), rebuilt from a Record if needed"""
+    if not isinstance(message, Record):
+        return message
+    return Message(id=message.id, peer_id=None, message=message.message, entities=message.entities,
+                   media=message.media, grouped_id=message.grouped_id, noforwards=message.noforwards,
+                   silent=message.silent, reply_markup=message.reply_markup)
+
+
+async def _sharded_pages(client, chat, offset: int, latest: int, page_size: int, shards: int):
+    """
+    Yield the messages of channel `chat` with `offset` < id <= `latest`, a window of `page_size` ids at a time.
+
+    Channel message ids are consecutive, so the range splits into windows
+    that are fetched by id, `shards` at once. The fetches wait in a queue in
+    id order and are handed out from its head, so a window that finishes
+    early waits for the ones before it: pages still come out oldest first,
+    and the sender's offset only moves over ranges that are complete.
+    """
+    async def fetch(start):
+        with metrics.timed('get_messages', chat=chat):
+            page = await client.get_messages(chat, ids=list(range(start, min(start + page_size, latest + 1))))
+        return [m for m in page if m is not None]
+
+    starts = iter(range(offset + 1, latest + 1, page_size))
+    in_flight = collections.deque()
+    try:
+        for start in starts:
+            in_flight.append(asyncio.ensure_future(fetch(start)))
+            if len(in_flight) >= shards:
+                yield await in_flight.popleft()
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def _history_pages(client, chat, offset: int, page_size: int, params: dict):
+    """
+    Yield the pages of messages of `chat` newer than `offset`, oldest first.
+
+    With FETCH_SHARDS above 1, the history of a channel up to its newest
+    message is fetched in parallel windows (see _sharded_pages); anything
+    posted meanwhile, and every other chat, is read page after page.
+    """
+    if FETCH_SHARDS > 1 and not params and isinstance(chat, InputPeerChannel):
+        newest = await client.get_messages(chat, limit=1)
+        if newest and newest[0].id - offset > page_size:
+            async with contextlib.aclosing(
+                    _sharded_pages(client, chat, offset, newest[0].id, page_size, FETCH_SHARDS)) as pages:
+                async for page in pages:
+                    yield page
+            offset = newest[0].id
+    while True:
+        with metrics.timed('get_messages', chat=chat):
+            page = await client.get_messages(chat, limit=page_size, offset_id=offset, reverse=True, **params)
+        if not page:
+            return
+        yield page
+        offset = page[-1].id
+        if len(page) < page_size:
+            return
+
+
+async def _fetch_pages(client, chat, offset: int, queues: list, page_size: int, raw: bool = False,
+                       spec=None) -> None:
+    """
+    Put pages of messages newer than `offset` on every queue in `queues`, oldest first, then None.
+
+    Pages hold Records, and the Messages they came from are dropped right
+    away, unless `raw` asks for the Messages themselves. With a section
+    filter `spec` (see filters.py), Telegram filters what it can and the
+    pages only hold the messages that pass the rest.
+    """
+    try:
+        params = await spec.params(client) if spec else {}
+        if spec:
+            offset = await spec.start(client, chat, offset)
+        async with contextlib.aclosing(_history_pages(client, chat, offset, page_size, params)) as pages:
+            async for page in pages:
+                if not page:
+                    continue  # A window of deleted messages
+                offset, fetched = page[-1].id, len(page)
+                done = spec and spec.done(page[-1])
+                if spec:
+                    page = [m for m in page if not isinstance(m, MessageService) and spec.matches(m)]
+                if not raw:
+                    page = [Record(m) for m in page if not isinstance(m, MessageService)]
+                if page:
+                    for queue in list(queues):
+                        await queue.put(page)
+                logger.debug(f'Prefetched {fetched} messages of {_name(chat)} up to {offset}')
+                if done:
+                    break
+    except Exception as err:
+        for queue in list(queues):
+            await queue.put(err)
+        return
+    for queue in list(queues):
+        await queue.put(None)
+
+
+class SharedSource:
+    """
+    One history fetch of a chat that feeds several sections reading it.
+
+    The fetch starts at the smallest offset of the sections and every page
+    goes to each reader's bounded queue, so the slowest reader sets the pace.
+    It starts once every section has subscribed or left, so a section that
+    fails before it reads (an unknown `to` chat, say) does not hold up the
+    others.
+    """
+
+    def __init__(self, offset: int, readers: int, spec=None):
+        self.offset = offset
+        self.readers = readers
+        self.spec = spec
+        self.queues = []
+        self.joined = set()  # sections that subscribed
+        self.fetcher = None
+
+    def _start(self) -> None:
+        # Start fetching once every reader has a queue, so no reader misses a page
+        if self.fetcher is None and self.queues and len(self.queues) >= self.readers:
+            self.fetcher = asyncio.create_task(
+                _fetch_pages(self.client, self.chat, self.offset, self.queues, self.page_size, spec=self.spec))
+
+    def subscribe(self, client, chat, page_size: int, depth: int) -> asyncio.Queue:
+        self.client, self.chat, self.page_size = client, chat, page_size
+        queue = asyncio.Queue(maxsize=depth)
+        self.queues.append(queue)
+        self.joined.add(current_pair.get())
+        self._start()
+        return queue
+
+    def leave(self, section) -> None:
+        """`section` has ended; if it never subscribed, stop waiting for it"""
+        if section not in self.joined and self.fetcher is None:
+            self.readers -= 1
+            self._start()
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.queues.remove(queue)
+        # Unblock the fetcher if it is waiting on this reader's full queue
+        while not queue.empty():
+            queue.get_nowait()
+        if self.fetcher is None:
+            # A reader gave up before the fetch started; do not wait for it
+            self.readers -= 1
+            self._start()
+        elif not self.queues:
+            self.fetcher.cancel()
+
+
+# Chats read by more than one section: (id(client), str(chat), filter key) -> SharedSource
+_shared = {}
+
+
+def _name(chat) -> str:
+    # Logs and metrics name a chat by its marked id, so the access hash of an InputPeer stays out of them
+    try:
+        return str(utils.get_peer_id(chat))
+    except (TypeError, ValueError):
+        return str(chat)
+
+
+def _key(client, chat, spec) -> tuple:
+    return id(client), str(chat), spec.key if spec else ()
+
+
+@contextlib.contextmanager
+def fan_out(client, chat, offset: int, readers: int, spec=None):
+    """
+    Let `readers` sections reading `chat` with the same filter share one history fetch from `offset`.
+
+    Inside the block, prefetch_messages(client, chat, ...) hands out the shared
+    pages instead of fetching again. All readers have to run at the same time,
+    each in a task tagged with its section (floodledger.current_pair), and
+    call leave() on the yielded SharedSource when they end.
+    """
+    key = _key(client, chat, spec)
+    _shared[key] = SharedSource(offset, readers, spec)
+    try:
+        yield _shared[key]
+    finally:
+        del _shared[key]
+
+
+async def prefetch_messages(client, chat, offset: int = 0, page_size: int = None, depth: int = None,
+                            raw: bool = False, spec=None):
+    """
+    Yield the messages of `chat` newer than `offset` in order, like
+    `client.iter_messages(chat, reverse=True, offset_id=offset)`.
+
+    A fetcher task keeps up to `depth` pages of `page_size` messages queued
+    ahead of the caller, so history requests run while the caller is sending.
+    The queue is bounded, so memory stays at `depth` pages however far behind
+    the sender is. An error raised by the fetcher is raised here. Inside
+    fan_out() the pages come from the shared fetch of the chat.
+
+    Messages come out as Records without service messages, or as the
+    Telethon Messages themselves with `raw`. Only the messages that pass
+    the section filter `spec` come out, if there is one. Once a signal asks
+    the run to stop (shutdown.py), the messages end after the current album.
+    """
+    page_size = page_size or PAGE_SIZE
+    depth = depth or PREFETCH_PAGES
+    shared = _shared.get(_key(client, chat, spec))
+    if shared:
+        queue = shared.subscribe(client, chat, page_size, depth)
+    else:
+        queue = asyncio.Queue(maxsize=depth)
+        fetcher = asyncio.create_task(_fetch_pages(client, chat, offset, [queue], page_size, raw, spec))
+    grouped_id = None
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            # An empty queue here means the sender is waiting for history
+            logger.debug(f'Prefetch queue of {_name(chat)}: {queue.qsize()}/{depth} pages ahead')
+            metrics.set_queue_depth(_name(chat), queue.qsize())
+            for message in page:
+                if stopping() and not (message.grouped_id and message.grouped_id == grouped_id):
+                    return
+                # A shared fetch starts at the smallest offset of its readers
+                if message.id > offset:
+                    grouped_id = message.grouped_id
+                    yield message
+    finally:
+        if shared:
+            shared.unsubscribe(queue)
+        else:
+            fetcher.cancel()
+
+
+async def group_albums(messages):
+    """
+    Yield the messages as lists: an album (consecutive messages sharing a
+    `grouped_id`) or a single message. Service messages are skipped.
+
+    Grouping works on the message stream, so an album split across two
+    history pages still comes out whole.
+    """
+    album = []
+    async for message in messages:
+        if isinstance(message, MessageService):
+            continue
+        if album and message.grouped_id and message.grouped_id == album[0].grouped_id:
+            album.append(message)
+            continue
+        if album:
+            yield album
+        album = [message]
+    if album:
+        yield album
+
+
+async def iter_chunks(messages, size):
+    """
+    Group consecutive non-service messages into lists of at most `size`, keeping source order.
+
+    An album is never split across two chunks, so it is forwarded in one
+    request and stays grouped at the destination.
+    """
+    chunk = []
+    async for album in group_albums(messages):
+        if chunk and len(chunk) + len(album) > size:
+            yield chunk
+            chunk = []
+        chunk.extend(album)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
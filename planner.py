@@ -0,0 +1,169 @@
+''' Estimate what a run would send, how many requests it needs and how long it takes, without sending anything. '''
+
+import logging
+import math
+
+from telethon.tl.functions.messages import GetSearchCountersRequest
+from telethon.tl.patched import MessageService
+from telethon.tl.types import (
+    InputMessagesFilterDocument, InputMessagesFilterGif, InputMessagesFilterMusic, InputMessagesFilterPhotos,
+    InputMessagesFilterRoundVideo, InputMessagesFilterVideo, InputMessagesFilterVoice, InputPeerChannel)
+
+from settings import API_ID, API_HASH, PAGE_SIZE, forwards, get_forward
+from sessionpool import SessionPool, account_of, build_sessions
+from strategy import capabilities
+from peers import preflight, resolve
+from filters import media_kinds, section_filter
+import floodledger
+
+logger = logging.getLogger(__name__)
+
+# Media counted by one GetSearchCounters request; everything else is text (or media without a file)
+COUNTERS = {
+    'photo': InputMessagesFilterPhotos,
+    'video': InputMessagesFilterVideo,
+    'gif': InputMessagesFilterGif,
+    'round': InputMessagesFilterRoundVideo,
+    'voice': InputMessagesFilterVoice,
+    'audio': InputMessagesFilterMusic,
+    'document': InputMessagesFilterDocument,
+}
+
+
+def duration(seconds: float) -> str:
+    """'2d 03h', '1h 05m', '4m 10s' or '12s'"""
+    seconds = int(seconds)
+    days, hours, minutes = seconds // 86400, seconds // 3600 % 24, seconds // 60 % 60
+    if days:
+        return f'{days}d {hours:02d}h'
+    if hours:
+        return f'{hours}h {minutes:02d}m'
+    if minutes:
+        return f'{minutes}m {seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+async def plan_pair(client, forward: str, limiter, batch_size: int = None, max_flood_wait: int = None) -> dict:
+    """
+    Estimate one config.ini section from a handful of requests.
+
+    The newest message gives the size of the chat and its last id, one
+    GetSearchCounters request the media counts, and one page after the
+    offset how often messages are service messages, albums or protected.
+    In a channel, ids are consecutive, so the share of the chat after the
+    offset is the share of its ids; other chats count in full unless the
+    rest fits in that page. Section filters that Telegram applies are
+    counted by Telegram; client-side filters are not, so those sections
+    show an upper bound.
+
+    `batch_size` is how many messages the engine forwards per request, or
+    None for an engine that copies every message or album (safe.py).
+    """
+    from_chat, to_chat, offset = get_forward(forward)
+    offset = offset or 0
+    from_peer, to_peer = await resolve(client, from_chat), await resolve(client, to_chat)
+    spec = section_filter(forward)
+    params = await spec.params(client) if spec else {}
+    if spec:
+        offset = await spec.start(client, from_peer, offset)
+
+    newest = await client.get_messages(from_peer, limit=1)
+    last_id = newest[0].id if newest else 0
+    total = newest.total if newest else 0
+    if params:
+        total = (await client.get_messages(from_peer, limit=0, **params)).total
+    else:
+        counters = await client(GetSearchCountersRequest(peer=from_peer, filters=[f() for f in COUNTERS.values()]))
+        media = {name: counter.count for name, counter in zip(COUNTERS, counters)}
+
+    sample = await client.get_messages(from_peer, limit=PAGE_SIZE, offset_id=offset, reverse=True, **params)
+    messages = [m for m in sample if not isinstance(m, MessageService)]
+    if last_id <= offset:
+        share = 0.0
+    elif isinstance(from_peer, InputPeerChannel):
+        share = (last_id - offset) / last_id
+    else:
+        share = 1.0
+    remaining = round(total * share)
+    if len(sample) < PAGE_SIZE:
+        remaining = len(messages)  # The whole rest of the chat was in the sample
+    elif sample:
+        remaining = round(remaining * len(messages) / len(sample))
+    if params:
+        # Telegram cannot count media within a filter, so the sample gives the mix
+        media = dict.fromkeys(COUNTERS, 0)
+        for message in messages:
+            for kind in media_kinds(message) & media.keys():
+                media[kind] += 1
+        total = len(messages)
+    scale = remaining / total if total else 0
+    breakdown = {name: round(count * scale) for name, count in media.items() if count}
+    breakdown['text'] = max(0, remaining - sum(breakdown.values()))
+
+    # How the sample would be sent: albums go out as one request, protected messages are copied
+    albums = len({m.grouped_id or -m.id for m in messages})
+    per_send = albums / len(messages) if messages else 1.0
+    protected = sum(1 for m in messages if m.noforwards) / len(messages) if messages else 0.0
+    restricted = not await capabilities.forwardable(client, from_peer)
+    copied = remaining if restricted or batch_size is None else round(remaining * protected)
+    forward_requests = math.ceil((remaining - copied) / batch_size) if batch_size else 0
+    copy_requests = math.ceil(copied * per_send)
+    files = sum(count for name, count in breakdown.items() if name != 'text')
+    reuploads = files if restricted else round(files * protected)
+    history_requests = math.ceil(remaining / PAGE_SIZE)
+
+    account = account_of(client)
+    eta = 0.0
+    if forward_requests:
+        eta += forward_requests / limiter.rate(to_peer, 'forward_messages', account)
+    if copy_requests:
+        eta += copy_requests / limiter.rate(to_peer, 'send_message', account)
+    method = 'forward_messages' if forward_requests else 'send_message'
+    longest_wait = floodledger.longest(account, method)
+    return {
+        'forward': forward,
+        'from': from_chat,
+        'to': to_chat,
+        'offset': offset,
+        'messages': remaining,
+        'upper_bound': bool(spec and not spec.server_only),
+        'breakdown': breakdown,
+        'restricted': restricted,
+        'history_requests': history_requests,
+        'forward_requests': forward_requests,
+        'copy_requests': copy_requests,
+        'reuploads': reuploads,
+        'eta': eta,
+        'longest_wait': longest_wait,
+        'over_ceiling': bool(max_flood_wait and longest_wait > max_flood_wait),
+    }
+
+
+def log_plan(plan: dict) -> None:
+    breakdown = ', '.join(f'{name} {count}' for name, count in plan['breakdown'].items() if count)
+    logger.info('[%s] %s → %s: %s%s messages after offset %s (%s)', plan['forward'], plan['from'], plan['to'],
+                'at most ' if plan['upper_bound'] else '~', plan['messages'], plan['offset'], breakdown or 'none')
+    logger.info('[%s] %s history + %s forward + %s copy requests, %s media re-uploads%s; ETA %s',
+                plan['forward'], plan['history_requests'], plan['forward_requests'], plan['copy_requests'],
+                plan['reuploads'], ' (forwarding is restricted)' if plan['restricted'] else '',
+                duration(plan['eta']))
+    if plan['over_ceiling']:
+        logger.warning('[%s] Flood waits of up to %ss were seen for this account, above MAX_FLOOD_WAIT; '
+                       'the section will likely be deferred', plan['forward'], plan['longest_wait'])
+
+
+async def plan_job(limiter, batch_size: int = None, max_flood_wait: int = None):
+    """Log the plan of every config.ini section and the totals, sending nothing"""
+    sessions = build_sessions()
+    assert API_ID is not None and API_HASH is not None, "API_ID and API_HASH must be set"
+
+    async with SessionPool(sessions, int(API_ID), str(API_HASH)) as pool:
+        await preflight(pool, forwards)
+        plans = []
+        for forward in forwards:
+            plans.append(await plan_pair(pool.main, forward, limiter, batch_size, max_flood_wait))
+            log_plan(plans[-1])
+        requests = sum(p['history_requests'] + p['forward_requests'] + p['copy_requests'] for p in plans)
+        logger.info('Plan: %s messages in %s section(s), %s requests, ETA %s one section at a time '
+                    '(from the current rates; flood waits come on top)', sum(p['messages'] for p in plans),
+                    len(plans), requests, duration(sum(p['eta'] for p in plans)))
@@ -0,0 +1,304 @@
+''' An adaptive token-bucket rate limiter that learns the request rate Telegram accepts. '''
+
+import asyncio
+import json
+import logging
+
+from telethon.errors.rpcerrorlist import FloodWaitError
+
+from settings import get_share
+from sessionpool import mark_flooded, paced
+from floodledger import FloodDeferred, current_pair
+import floodledger
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CONFIG = {
+    'STATE_FILE': 'rate_limits.json',  # Learned rates are kept here between runs
+    'BURST': 1,  # Requests a bucket may send back to back after being idle
+    'MIN_RATE': 0.02,  # Lowest rate a bucket may fall to (requests/second)
+    'INCREASE': 0.01,  # Added to the rate after every successful request (requests/second)
+    'DECREASE': 0.5,  # The rate is multiplied by this after a FloodWaitError
+    'PRIORITY_AGING': 10,  # Seconds of waiting that raise a section by one priority level on a shared account
+}
+
+
+def _now() -> float:
+    # The event loop clock, so simulated clocks (see benchmark.py) pace requests too
+    return asyncio.get_running_loop().time()
+
+
+class FairLock:
+    """
+    A lock that, when several sections wait for it, goes to the section whose turn it is.
+
+    Sections of the same priority take turns by weighted fair queuing:
+    every turn moves a section's virtual finish time on by 1/weight, and
+    the waiter that would finish first goes next, so busy sections share
+    the lock in proportion to their weights. A section that was idle starts
+    at the current virtual time, so it neither saved up turns nor queues
+    behind the backlog of the others. A higher `priority` goes first, but
+    a waiter rises one level every CONFIG['PRIORITY_AGING'] seconds, so
+    low-priority backfills still make progress.
+
+    A turn only counts once the holder calls served(): a holder that
+    leaves without using it (its destination was not ready) keeps its
+    place. The holder also keeps the lock a while after it leaves, so the
+    next turn is picked when it can start rather than when the last one
+    began: a section that was still busy sending by then is back in the
+    queue and competes for it.
+
+    The section is the one the calling task runs (floodledger.current_pair),
+    with priority and weight from config.ini (settings.get_share).
+    """
+
+    def __init__(self):
+        self.held = False
+        self.holder = (None, 0.0)  # section holding the lock, waiting since
+        self.competing = set()  # sections that were waiting when the holder got the lock
+        self.keep = 0.0  # seconds the lock stays held after the holder leaves
+        self.waiters = []  # (section, future, waiting since)
+        self.finish = {}  # section -> virtual finish time of its last turn
+        self.clock = 0.0  # virtual start time of the last turn
+
+    def _start(self, section) -> float:
+        return max(self.finish.get(section, 0.0), self.clock)
+
+    def _rank(self, waiter, now: float) -> tuple:
+        section, _, since = waiter
+        priority, weight = get_share(section)
+        level = priority + int((now - since) // CONFIG['PRIORITY_AGING'])
+        return -level, self._start(section) + 1 / weight
+
+    def _release(self) -> None:
+        if not self.waiters:
+            self.held = False
+            return
+        now = _now()
+        self.competing = {w[0] for w in self.waiters}
+        waiter = min(self.waiters, key=lambda w: self._rank(w, now))
+        self.waiters.remove(waiter)
+        waiter[1].set_result(None)
+
+    def _share(self, section) -> None:
+        """
+        For the run summary: count who got the turn, and whom it was owed to.
+
+        The turn is owed to the sections with the highest priority among the
+        ones that were waiting for it, split by weight, so a section that
+        should have gone first but did not shows up below its share.
+        """
+        competing = {s for s in self.competing | {section} if s}
+        top = max(get_share(s)[0] for s in competing)
+        weights = {s: get_share(s)[1] for s in competing if get_share(s)[0] == top}
+        if len(competing) > 1:
+            for s, weight in weights.items():
+                metrics.count(s, 'owed_turns', weight / sum(weights.values()))
+            metrics.count(section, 'shared_turns')
+
+    async def __aenter__(self):
+        section, since = current_pair.get(), _now()
+        if self.held:
+            waiter = (section, asyncio.get_running_loop().create_future(), since)
+            self.waiters.append(waiter)
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                else:
+                    self._release()  # The turn came just as the task was cancelled
+                raise
+        else:
+            self.competing = set()
+        self.held = True
+        self.holder = (section, since)
+
+    def served(self, keep: float) -> None:
+        """The holder used its turn; the lock stays held `keep` seconds after it leaves"""
+        section, since = self.holder
+        start = self._start(section)
+        self.finish[section] = start + 1 / get_share(section)[1]
+        self.clock = start
+        self.keep = keep
+        if section:
+            metrics.count(section, 'sends')
+            metrics.count(section, 'wait_ms', int((_now() - since) * 1000))
+            self._share(section)
+
+    async def __aexit__(self, *args):
+        keep, self.keep = self.keep, 0.0
+        if keep > 0:
+            asyncio.get_running_loop().call_later(keep, self._release)
+        else:
+            self._release()
+
+
+class TokenBucket:
+    """A token bucket whose rate grows additively and shrinks multiplicatively"""
+
+    def __init__(self, rate: float, max_rate: float):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.tokens = CONFIG['BURST']
+        self.updated = _now()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(CONFIG['BURST'], self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, max_wait: float = None, method: str = None) -> float:
+        """
+        Seconds until a token is available (0 if one is).
+
+        Raises:
+            FloodDeferred: The bucket is blocked for longer than `max_wait` seconds
+        """
+        now = _now()
+        self._refill(now)
+        if max_wait is not None and self.blocked_until - now > max_wait:
+            raise FloodDeferred(int(self.blocked_until - now) + 1, method)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1 - 1e-9:  # tolerate float rounding after a timed wait
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + CONFIG['INCREASE'])
+
+    def on_flood(self) -> None:
+        self.rate = max(CONFIG['MIN_RATE'], self.rate * CONFIG['DECREASE'])
+        self.tokens = 0
+
+    def block(self, seconds: int) -> None:
+        """Hold back every request of this bucket for `seconds`"""
+        self.blocked_until = max(self.blocked_until, _now() + seconds)
+
+
+class RateLimiter:
+    """
+    Paces requests with one token bucket per account, per destination and per method.
+
+    Every request has to take a token from all three buckets. The sections
+    sharing an account get its tokens in turn, by priority and weight (see
+    FairLock), and take all three tokens within their turn, so no later
+    bucket reorders the sends. Successful requests raise the rates a little, a
+    FloodWaitError halves them and blocks that method until the wait is
+    over. The learned rates are saved to CONFIG['STATE_FILE'] and picked up
+    again on the next run.
+
+    Args:
+        initial_rate: Rate of a bucket that has not learned anything yet (requests/second)
+        max_rate: Highest rate a bucket may reach (requests/second)
+        max_wait: If set, a call whose method is blocked for longer than this
+            many seconds raises FloodDeferred instead of waiting
+    """
+
+    def __init__(self, initial_rate: float, max_rate: float = None, max_wait: float = None):
+        self.initial_rate = initial_rate
+        self.max_rate = max_rate or initial_rate * 4
+        self.max_wait = max_wait
+        self.buckets = {}
+        self.turns = {}  # account -> FairLock handing out its turns
+        self.learned = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(CONFIG['STATE_FILE']) as state:
+                return json.load(state)
+        except FileNotFoundError:
+            return {}
+        except Exception as err:
+            logger.warning(f'Could not read learned rates from {CONFIG["STATE_FILE"]}: {err}')
+            return {}
+
+    def save(self) -> None:
+        """Write the learned rates of every bucket to CONFIG['STATE_FILE']"""
+        self.learned.update({key: bucket.rate for key, bucket in self.buckets.items()})
+        try:
+            with open(CONFIG['STATE_FILE'], 'w') as state:
+                json.dump(self.learned, state, indent=2, sort_keys=True)
+        except Exception as err:
+            logger.warning(f'Could not save learned rates to {CONFIG["STATE_FILE"]}: {err}')
+
+    def _bucket(self, key: str) -> TokenBucket:
+        if key not in self.buckets:
+            rate = min(self.learned.get(key, self.initial_rate), self.max_rate)
+            self.buckets[key] = TokenBucket(rate, self.max_rate)
+        return self.buckets[key]
+
+    def _buckets(self, destination, method: str, account: str) -> list:
+        return [
+            self._bucket(f'account:{account}'),
+            self._bucket(f'destination:{account}:{destination}'),
+            self._bucket(f'method:{account}:{method}'),
+        ]
+
+    def rate(self, destination, method: str, account: str = 'default') -> float:
+        """The requests/second a call with these keys gets now: the slowest of its buckets"""
+        return min(bucket.rate for bucket in self._buckets(destination, method, account))
+
+    async def _take(self, buckets, method: str, account: str) -> None:
+        """
+        Take a token from every bucket in one turn of the account.
+
+        The next turn is handed out once the account has its next token, so
+        the sends go out in the order FairLock picks and a busy section is
+        back in the queue by then. A destination or method that is slower
+        than the account is waited for outside the turn, so it does not
+        hold up the other sections of the account.
+        """
+        own, others = buckets[0], buckets[1:]
+        turns = self.turns.setdefault(account, FairLock())
+        while True:
+            async with turns:
+                while True:
+                    wait = max(bucket.delay(self.max_wait, method) for bucket in others)
+                    ready = own.delay(self.max_wait, method)
+                    if wait > ready:
+                        break
+                    if not ready:
+                        for bucket in buckets:
+                            bucket.consume()
+                        turns.served(own.delay())
+                        return
+                    await asyncio.sleep(ready)
+            await asyncio.sleep(wait)
+
+    async def call(self, operation_func, destination, method: str, account: str = 'default'):
+        """
+        Run `operation_func()` once its buckets allow it and learn from the outcome.
+
+        A FloodWaitError is recorded and then raised again, so the caller's own
+        retry handling still applies. With `max_wait`, a call on a method that
+        is blocked for longer raises FloodDeferred right away.
+        """
+        buckets = self._buckets(destination, method, account)
+        await self._take(buckets, method, account)
+        # Telethon raises every flood wait of this request instead of sleeping through the short ones
+        token = paced.set(True)
+        try:
+            with metrics.timed(method, destination=destination, account=account):
+                result = await operation_func()
+        except FloodWaitError as fwe:
+            metrics.flood(method, fwe.seconds)
+            for bucket in buckets:
+                bucket.on_flood()
+            # Telegram's flood waits apply to one method of an account
+            buckets[-1].block(fwe.seconds)
+            mark_flooded(account, fwe.seconds)
+            floodledger.record(account, method, fwe.seconds)
+            logger.info(f'Rate for {method} to {destination} lowered to {buckets[-1].rate:.3f} requests/second')
+            self.save()
+            raise
+        finally:
+            paced.reset(token)
+        for bucket in buckets:
+            bucket.on_success()
+        return result
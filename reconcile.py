@@ -0,0 +1,204 @@
+''' Find the messages a section skipped or lost below its offset and send only those. '''
+
+import argparse
+import asyncio
+import logging
+
+from telethon.errors.rpcerrorlist import FloodWaitError
+from telethon.tl.patched import MessageService
+from telethon.tl.types import InputPeerChannel
+
+from settings import API_ID, API_HASH, configur, forwards, get_forward, checkpoints
+from dedup import dedup
+import metrics
+import memory
+from sessionpool import SessionPool, account_of, build_sessions
+from pipeline import Record, iter_chunks
+from strategy import deliver
+from transfer import pipeline
+from peers import preflight, resolve
+from forwarder import limiter, safe_forward, safe_send_copy
+from filters import section_filter
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+CONFIG = {
+    'RANGE': 10000,  # Source ids compared per step
+    'BATCH_SIZE': 100,  # Ids per GetMessages request and messages per forward request (Telegram allows at most 100)
+}
+
+
+def spans(ids) -> str:
+    """Compact sorted ids into '3, 7-9, 15' for the log"""
+    parts = []
+    for message_id in ids:
+        if parts and parts[-1][1] == message_id - 1:
+            parts[-1][1] = message_id
+        else:
+            parts.append([message_id, message_id])
+    return ', '.join(str(first) if first == last else f'{first}-{last}' for first, last in parts)
+
+
+class Reconciler:
+    """
+    Compares one section's source history with what reached its destination.
+
+    The map of sent messages (checkpoint.py) is read one id range at a time.
+    Channel message ids are consecutive, so in a channel or supergroup only
+    the ids without a map entry can be missing, and only those are fetched
+    from the source, 100 per request. A chat where nothing is missing costs
+    no request at all, and a deleted source message is a None in a batch.
+    Other chats share their id sequence with the whole account, so there the
+    history of the range is read instead. Messages sent before the map
+    existed, or skipped as duplicates, are recognized by the dedup index
+    when DEDUP is on. Messages the section's filters leave out are not
+    missing.
+
+    With `verify`, the destination ids of the map are also fetched, 100 per
+    request, so messages deleted from the destination are sent again.
+    """
+
+    def __init__(self, client, forward: str, verify: bool):
+        self.client = client
+        self.forward = forward
+        self.spec = section_filter(forward)
+        self.verify = verify
+        self.requests = 0
+        self.lost = set()
+
+    async def _get(self, peer, ids):
+        """The messages `ids` of `peer` (None where there is none), sitting out flood waits"""
+        while True:
+            try:
+                self.requests += 1
+                return await limiter.call(lambda: self.client.get_messages(peer, ids=ids),
+                                          peer, 'get_messages', account_of(self.client))
+            except FloodWaitError as fwe:
+                logging.warning(f'Flood wait for reading messages: {fwe.seconds} seconds')
+                metrics.retry('get_messages')
+                await asyncio.sleep(fwe.seconds)
+
+    async def _history(self, peer, first: int, last: int) -> list:
+        """The messages of `peer` with `first` <= id <= `last`"""
+        messages = [m async for m in self.client.iter_messages(peer, min_id=first - 1, max_id=last + 1, reverse=True)]
+        self.requests += len(messages) // CONFIG['BATCH_SIZE'] + 1
+        return messages
+
+    async def _verify(self, to_peer, sent: dict) -> None:
+        """Drop the map entries whose destination message no longer exists"""
+        sources = list(sent)
+        for start in range(0, len(sources), CONFIG['BATCH_SIZE']):
+            batch = sources[start:start + CONFIG['BATCH_SIZE']]
+            found = await self._get(to_peer, [sent[source] for source in batch])
+            lost = [source for source, message in zip(batch, found) if message is None]
+            checkpoints.forget(self.forward, lost)
+            self.lost.update(lost)
+            for source in lost:
+                del sent[source]
+
+    async def missing(self, from_peer, to_peer, to_chat, first: int, last: int):
+        """Yield the Records of the source messages with `first` < id <= `last` that are not at the destination"""
+        for start in range(first + 1, last + 1, CONFIG['RANGE']):
+            end = min(start + CONFIG['RANGE'] - 1, last)
+            sent = checkpoints.mapped(self.forward, start, end)
+            if self.verify and sent:
+                await self._verify(to_peer, sent)
+            if isinstance(from_peer, InputPeerChannel):
+                unknown = [i for i in range(start, end + 1) if i not in sent]
+                batches = (unknown[i:i + CONFIG['BATCH_SIZE']] for i in range(0, len(unknown), CONFIG['BATCH_SIZE']))
+            else:
+                batches = [[m.id for m in await self._history(from_peer, start, end) if m.id not in sent]]
+            for batch in batches:
+                for record in await self._check(from_peer, to_chat, batch):
+                    yield record
+
+    async def _check(self, from_peer, to_chat, ids) -> list:
+        """The Records of the source messages `ids` that still have to be sent"""
+        result = []
+        for message in await self._get(from_peer, ids) if ids else []:
+            if message is None or isinstance(message, MessageService):
+                continue  # Deleted in the source, or a service message that is never sent
+            if self.spec and not self.spec.matches(message, everything=True):
+                continue
+            record = Record(message)
+            if dedup and record.id not in self.lost and dedup.seen(to_chat, record):
+                metrics.count(self.forward, 'skipped')
+                continue
+            result.append(record)
+        return result
+
+
+async def reconcile_pair(client, forward: str, dry_run: bool, verify: bool, from_offset: bool = False) -> dict:
+    """
+    Send the missing messages of one config.ini section below its offset and return its report.
+
+    The check starts at the oldest mapped message, since messages sent
+    before the map existed cannot be told apart from missing ones without
+    DEDUP. With `from_offset`, it starts at the config.ini offset instead,
+    if that is earlier.
+    """
+    from_chat, to_chat, offset = get_forward(forward)
+    from_peer, to_peer = await resolve(client, from_chat), await resolve(client, to_chat)
+    first = configur.getint(forward, 'offset')
+    oldest = checkpoints.first_mapped(forward)
+    if oldest is not None:
+        first = min(first, oldest - 1) if from_offset else oldest - 1
+    reconciler = Reconciler(client, forward, verify)
+    if reconciler.spec:
+        await reconciler.spec.params(client)  # Resolves the `sender` filter
+    found = []
+    logging.info('Reconciling %s from message %s to %s', forward, first + 1, offset)
+    async for chunk in iter_chunks(reconciler.missing(from_peer, to_peer, to_chat, first, offset), CONFIG['BATCH_SIZE']):
+        found.extend(m.id for m in chunk)
+        if dry_run:
+            continue
+        await deliver(client, from_peer, forward, chunk,
+                      lambda batch: safe_forward(client, to_peer, from_peer, batch),
+                      lambda album, reply_to: safe_send_copy(client, from_peer, to_peer, album, reply_to),
+                      lambda album: pipeline.prepare(client, album))
+        metrics.count(forward, 'reconciled', len(chunk))
+        if dedup:
+            for m in chunk:
+                dedup.add(to_chat, m)
+    if found:
+        logging.info('%s: %s missing message(s)%s: %s', forward, len(found), '' if dry_run else ' sent',
+                     spans(found))
+    logging.info('Reconciled %s with %s read request(s)', forward, reconciler.requests)
+    return {'from': from_chat, 'to': to_chat, 'missing': len(found), 'requests': reconciler.requests}
+
+
+async def reconcile_job(dry_run: bool, verify: bool, from_offset: bool = False):
+    """Reconcile every config.ini section, one after the other"""
+    sessions = build_sessions()
+    assert API_ID is not None and API_HASH is not None, "API_ID and API_HASH must be set"
+
+    async with SessionPool(sessions, int(API_ID), str(API_HASH)) as pool, metrics.Exporter(), memory.Monitor(pool):
+        await preflight(pool, forwards)
+        reports = []
+        for forward in forwards:
+            client = await pool.acquire()
+            try:
+                reports.append(await reconcile_pair(client, forward, dry_run, verify, from_offset))
+            finally:
+                pool.release(client)
+        limiter.save()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
+        for report in reports:
+            logging.info('%s → %s: %s missing, %s read request(s)', report['from'], report['to'],
+                         report['missing'], report['requests'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dry-run', action='store_true', help='only list the missing messages')
+    parser.add_argument('--verify', action='store_true',
+                        help='also check that the sent messages still exist in the destination')
+    parser.add_argument('--from-offset', action='store_true',
+                        help='start at the config.ini offset instead of the oldest message in the map')
+    args = parser.parse_args()
+
+    assert forwards, "No forwards configured in settings.py"
+    asyncio.run(reconcile_job(dry_run=args.dry_run, verify=args.verify, from_offset=args.from_offset))
@@ -1,13 +1,13 @@
 ''' A script to send all messages from one chat to another with robust flood wait handling. '''
 
+import argparse
 import asyncio
 import logging
-import random
 import time
 from typing import Optional
 
-from telethon.tl.patched import MessageService
 from telethon.errors.rpcerrorlist import FloodWaitError, SessionPasswordNeededError
+from telethon.tl.types import DocumentAttributeFilename
 from telethon.errors import (
     AuthKeyError, 
     PhoneCodeExpiredError,
@@ -15,9 +15,22 @@ from telethon.errors import (
     ChannelPrivateError,
     ChatAdminRequiredError
 )
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from settings import API_ID, API_HASH, forwards, get_forward, update_offset, STRING_SESSION
+from settings import API_ID, API_HASH, forwards, get_forward, update_offset, checkpoints, saved_config
+from scheduler import fairness, run_pairs
+from daemon import run_daemon
+from dedup import dedup
+from peers import preflight, resolve
+from filters import section_filter
+from strategy import capabilities, protected, remember, reply_target
+from transfer import pipeline
+import metrics
+import memory
+from sessionpool import SessionPool, account_of, build_sessions
+from pipeline import prefetch_messages, group_albums, as_message
+from planner import plan_job
+from ratelimit import RateLimiter
+from floodledger import FloodDeferred, record
+from shutdown import Shutdown, resume, stopping
 
 # Enhanced logging with more detail
 logging.basicConfig(
@@ -30,8 +43,8 @@ SENT_VIA = f'\n__Sent via__ `{str(__file__)}`'
 
 # Configuration for rate limiting and flood wait prevention
 CONFIG = {
-    'MIN_DELAY': 1.5,  # Minimum delay between messages (seconds) - IMPORTANT for account safety
-    'MAX_DELAY': 3.0,  # Maximum delay between messages (seconds)
+    'INITIAL_RATE': 0.4,  # Messages per second until a rate has been learned
+    'MAX_RATE': 0.66,  # Highest rate the limiter may learn (messages/second) - IMPORTANT for account safety
     'RETRY_ATTEMPTS': 5,  # Number of retry attempts for failed operations
     'RETRY_DELAY': 2,  # Initial retry delay (seconds) - will use exponential backoff
     'FLOOD_WAIT_BUFFER': 5,  # Extra seconds to add to flood wait time
@@ -40,19 +53,10 @@ CONFIG = {
 }
 
 
-def intify(string):
-    """Convert string to int if possible, otherwise return as is"""
-    try:
-        return int(string)
-    except:
-        return string
-
-
-async def smart_delay():
-    """Add a random delay between messages to avoid rate limits"""
-    delay = random.uniform(CONFIG['MIN_DELAY'], CONFIG['MAX_DELAY'])
-    logger.debug(f'Smart delay: {delay:.2f} seconds')
-    await asyncio.sleep(delay)
+# Paces every request and learns from flood waits instead of sleeping a fixed delay;
+# a method held back for longer than MAX_FLOOD_WAIT defers the section instead
+limiter = RateLimiter(initial_rate=CONFIG['INITIAL_RATE'], max_rate=CONFIG['MAX_RATE'],
+                      max_wait=CONFIG['MAX_FLOOD_WAIT'])
 
 
 async def safe_operation(operation_func, operation_name: str, max_retries: int = None):
@@ -66,6 +70,9 @@ async def safe_operation(operation_func, operation_name: str, max_retries: int =
     
     Returns:
         Result of the operation or None if all retries failed
+
+    Raises:
+        FloodDeferred: The flood wait, or what is left of an earlier one, is longer than MAX_FLOOD_WAIT
     """
     if max_retries is None:
         max_retries = CONFIG['RETRY_ATTEMPTS']
@@ -87,9 +94,9 @@ async def safe_operation(operation_func, operation_name: str, max_retries: int =
             if wait_time > CONFIG['MAX_FLOOD_WAIT']:
                 logger.error(
                     f'Flood wait time ({wait_time}s) exceeds maximum allowed ({CONFIG["MAX_FLOOD_WAIT"]}s). '
-                    f'Skipping {operation_name}.'
+                    f'Deferring {operation_name}.'
                 )
-                return None
+                raise FloodDeferred(wait_time, operation_name)
             
             logger.warning(
                 f'Flood wait for {operation_name}: {wait_time} seconds '
@@ -97,8 +104,12 @@ async def safe_operation(operation_func, operation_name: str, max_retries: int =
             )
             await asyncio.sleep(wait_time)
             retry_count += 1
+            metrics.retry(operation_name)
             continue
             
+        except FloodDeferred:
+            raise
+
         except (ChannelPrivateError, ChatAdminRequiredError) as err:
             logger.error(f'Permission error for {operation_name}: {err}. Skipping.')
             return None
@@ -114,6 +125,7 @@ async def safe_operation(operation_func, operation_name: str, max_retries: int =
                     f'Error in {operation_name} (attempt {retry_count}/{max_retries}): {err}. '
                     f'Retrying in {backoff_time} seconds...'
                 )
+                metrics.retry(operation_name)
                 await asyncio.sleep(backoff_time)
             else:
                 logger.error(
@@ -127,7 +139,7 @@ async def safe_operation(operation_func, operation_name: str, max_retries: int =
 async def safe_send_message(client, entity, message, **kwargs):
     """Safely send a message with smart rate limiting and flood wait handling"""
     async def send():
-        return await client.send_message(entity, message, **kwargs)
+        return await limiter.call(lambda: client.send_message(entity, message, **kwargs), entity, 'send_message', account_of(client))
     
     return await safe_operation(send, 'send_message')
 
@@ -135,19 +147,131 @@ async def safe_send_message(client, entity, message, **kwargs):
 async def safe_send_file(client, entity, file, **kwargs):
     """Safely send a file with flood wait handling"""
     async def send():
-        return await client.send_file(entity, file, **kwargs)
+        return await limiter.call(lambda: client.send_file(entity, file, **kwargs), entity, 'send_file', account_of(client))
     
     return await safe_operation(send, 'send_file')
 
 
-async def forward_job():
+async def safe_send_album(client, entity, album, media=None, reply_to=None):
+    """Safely send an album (messages sharing a grouped_id) as one media group, or `media` in place of its own"""
+    media = media or [m.media for m in album]
+    if len(album) == 1 and media[0] is None:
+        return await safe_send_message(client, entity, album[0].message, formatting_entities=album[0].entities,
+                                       reply_to=reply_to)
+    if len(album) == 1:
+        return await safe_send_file(client, entity, media[0], caption=album[0].message or '',
+                                    formatting_entities=album[0].entities, reply_to=reply_to)
+    return await safe_send_file(
+        client, entity, media,
+        caption=[m.message or '' for m in album],
+        formatting_entities=[m.entities or [] for m in album],
+        reply_to=reply_to
+    )
+
+
+async def to_saved_messages(pool, send):
+    """Run `send(client)` on the first account that is not held back by a long flood wait; None if every one is"""
+    for client in pool.clients:
+        try:
+            return await send(client)
+        except FloodDeferred:
+            logger.warning(f'{account_of(client)} is waiting out a flood wait, trying the next account')
+    return None
+
+
+async def forward_pair(client, forward):
+    """Forward the new messages of one config.ini section and return its report"""
+    last_id = 0
+    messages_in_this_forward = 0
+    error_count = 0
+    from_chat = to_chat = None
+    offset = 0
+    deferred = False
+
+    try:
+        from_chat, to_chat, offset = get_forward(forward)
+
+        if not offset:
+            offset = 0
+
+        logger.info(f'Starting forward: {forward} (from: {from_chat}, to: {to_chat}, offset: {offset})')
+
+        from_peer, to_peer = await resolve(client, from_chat), await resolve(client, to_chat)
+        # A send the last run could not confirm is looked up in the destination first
+        offset = await resume(client, forward, from_peer, to_peer, offset)
+        # Look up once whether the source restricts forwarding, which also rules out sending its media by reference
+        await capabilities.forwardable(client, from_peer)
+        async for album in group_albums(prefetch_messages(client, from_peer, offset, spec=section_filter(forward))):
+            if dedup and all(dedup.seen(to_chat, m) for m in album):
+                metrics.log_message(logger, '↷ Skipped message %s, already sent to %s', album[-1].id, to_chat)
+                metrics.count(forward, 'skipped', len(album))
+                last_id = str(album[-1].id)
+                update_offset(forward, last_id)
+                continue
+
+            # Send message (or the whole album in one call) with safe operation, replying where the source does
+            reply_to = reply_target(forward, album[0])
+            checkpoints.begin(forward, album[0].id, album[-1].id)
+            if protected(from_peer, album):
+                # Protected media cannot be sent by reference, so it is re-uploaded through the media pipeline
+                result = await safe_send_album(client, to_peer, album, await pipeline.media(client, album), reply_to)
+            elif len(album) == 1:
+                result = await safe_send_message(client, to_peer, as_message(album[0]), reply_to=reply_to)
+            else:
+                result = await safe_send_album(client, to_peer, album, reply_to=reply_to)
+
+            if result is not None:
+                remember(forward, album, result, copied=True)
+                if dedup:
+                    for m in album:
+                        dedup.add(to_chat, m)
+                last_id = str(album[-1].id)
+                messages_in_this_forward += len(album)
+                metrics.log_message(logger, '✓ Forwarded message %s (%s: %s)', last_id, forward, messages_in_this_forward)
+                metrics.count(forward, 'forwarded', len(album))
+                update_offset(forward, last_id)
+                checkpoints.confirm(forward)
+            else:
+                error_count += 1
+                logger.warning(f'✗ Failed to forward message {album[-1].id}')
+                metrics.count(forward, 'failed')
+                # Continue with next message instead of breaking
+
+        logger.info(
+            f'Completed forward: {forward} '
+            f'(processed: {messages_in_this_forward} messages)'
+        )
+
+    except FloodDeferred as fd:
+        # Stop here without moving the offset; check_flood_wait.py resumes this forward later
+        record(account_of(client), fd.method, fd.seconds, deferred=True)
+        deferred = True
+        logger.warning(
+            f'Deferred forward {forward} at offset {last_id or offset} until '
+            f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(fd.deadline))}'
+        )
+
+    except Exception as err:
+        logger.exception(f'Critical error processing forward {forward}: {err}')
+        error_count += 1
+        # Continue with next forward instead of stopping
+
+    return {
+        'from': from_chat,
+        'to': to_chat,
+        'final_offset': last_id or offset,
+        'forwarded': messages_in_this_forward,
+        'errors': error_count,
+        'deferred': deferred
+    }
+
+
+async def forward_job(daemon: bool = False):
     """Main forwarding job with comprehensive error handling"""
     start_time = time.time()
     
-    if STRING_SESSION:
-        session = StringSession(STRING_SESSION)
-    else:
-        session = 'forwarder'
+    # One session per account; several accounts share the sections between them
+    sessions = build_sessions()
 
     # Ensure API credentials are valid
     assert API_ID is not None and API_HASH is not None, \
@@ -157,10 +281,9 @@ async def forward_job():
     api_hash = str(API_HASH)
 
     logger.info('Starting Telegram Chat Forward script...')
-    logger.info(f'Configuration: MIN_DELAY={CONFIG["MIN_DELAY"]}s, MAX_DELAY={CONFIG["MAX_DELAY"]}s')
+    logger.info(f'Configuration: INITIAL_RATE={CONFIG["INITIAL_RATE"]}/s, MAX_RATE={CONFIG["MAX_RATE"]}/s')
 
-    async with TelegramClient(session, api_id, api_hash) as client:
-        
+    async with SessionPool(sessions, api_id, api_hash) as pool, metrics.Exporter(), memory.Monitor(pool):
         # Skip user input if in auto mode (for server deployment)
         if not CONFIG['AUTO_MODE']:
             confirm = ''' IMPORTANT 🛑
@@ -174,55 +297,18 @@ async def forward_job():
         else:
             logger.info('Running in AUTO MODE (server deployment)')
 
-        total_messages = 0
-        error_count = 0
-        
-        for forward in forwards:
-            try:
-                from_chat, to_chat, offset = get_forward(forward)
-                
-                if not offset:
-                    offset = 0
-
-                logger.info(f'Starting forward: {forward} (from: {from_chat}, to: {to_chat}, offset: {offset})')
-                
-                last_id = 0
-                messages_in_this_forward = 0
-
-                async for message in client.iter_messages(intify(from_chat), reverse=True, offset_id=offset):
-                    if isinstance(message, MessageService):
-                        logger.debug(f'Skipping service message: {message.id}')
-                        continue
-                    
-                    # Send message with safe operation
-                    result = await safe_send_message(client, intify(to_chat), message)
-                    
-                    if result is not None:
-                        last_id = str(message.id)
-                        total_messages += 1
-                        messages_in_this_forward += 1
-                        logger.info(
-                            f'✓ Forwarded message {last_id} '
-                            f'(total: {total_messages}, this forward: {messages_in_this_forward})'
-                        )
-                        update_offset(forward, last_id)
-                        
-                        # Smart delay to prevent rate limits
-                        await smart_delay()
-                    else:
-                        error_count += 1
-                        logger.warning(f'✗ Failed to forward message {message.id}')
-                        # Continue with next message instead of breaking
-
-                logger.info(
-                    f'Completed forward: {forward} '
-                    f'(processed: {messages_in_this_forward} messages)'
-                )
-
-            except Exception as err:
-                logger.exception(f'Critical error processing forward {forward}: {err}')
-                error_count += 1
-                # Continue with next forward instead of stopping
+        await preflight(pool, forwards)
+        async with Shutdown():
+            reports = await run_pairs(forwards, forward_pair, pool)
+        if stopping():
+            limiter.save()
+            return
+        total_messages = sum(r['forwarded'] for r in reports)
+        error_count = sum(r['errors'] for r in reports)
+        limiter.save()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
 
         # Calculate statistics
         elapsed_time = time.time() - start_time
@@ -232,16 +318,23 @@ async def forward_job():
         logger.info(f'Errors encountered: {error_count}')
         logger.info(f'Time elapsed: {elapsed_time:.2f} seconds')
         logger.info(f'Average rate: {total_messages/elapsed_time*60:.2f} messages/minute')
+        for r in reports:
+            logger.info(
+                f'{r["from"]} → {r["to"]}: {r["forwarded"]} messages, offset {r["final_offset"]}'
+                f'{" (deferred, run check_flood_wait.py to resume)" if r["deferred"] else ""}'
+            )
         logger.info('='*60)
 
-        # Send config file backup
-        config_result = await safe_send_file(
-            client, 
-            'me', 
-            'config.ini', 
-            caption='✅ Your config file for telegram-chat-forward (backup)'
-        )
-        
+        # Send config.ini with the saved offsets as a backup, from an account that is not waiting out a flood wait
+        config_result = await to_saved_messages(pool, lambda sender: safe_send_file(
+            sender,
+            'me',
+            saved_config(),
+            attributes=[DocumentAttributeFilename('config.ini')],
+            force_document=True,
+            caption='✅ Your config file for telegram-chat-forward, with the saved offsets (backup)'
+        ))
+
         if config_result is None:
             logger.warning('Failed to send config file backup')
 
@@ -253,6 +346,17 @@ async def forward_job():
             else f'Forward job completed with {error_count} errors. Check logs for details.'
         )
         
+        pair_lines = "\n".join(
+            f"• {r['from']} → {r['to']}: {r['final_offset']} ({r['forwarded']} messages"
+            f"{', deferred by flood wait' if r['deferred'] else ''})" for r in reports
+        )
+        # How the sections shared the accounts
+        share_lines = fairness(forwards) if len(forwards) > 1 else []
+        for line in share_lines:
+            logger.info(line)
+        if share_lines:
+            pair_lines += '\n\n⚖️ **Sections:**\n' + '\n'.join(share_lines)
+
         final_message = f'''{status_emoji} Hi!
 
 **{message_text}**
@@ -262,22 +366,43 @@ async def forward_job():
 • Errors: {error_count}
 • Time taken: {elapsed_time/60:.1f} minutes
 • Average rate: {total_messages/elapsed_time*60:.1f} msgs/min
+• Duplicates skipped: {dedup.skipped if dedup else 0}
+
+📌 **Offsets:**
+{pair_lines}
+
+The offsets are saved in checkpoints.db, and the next run resumes from them. The config.ini backup has them too, to resume on another machine. To start a section from another message, change its offset in config.ini.
 
 **Telegram Chat Forward** is developed by @AahnikDaw.
 Please star 🌟 on [GitHub](https://github.com/aahnik/telegram-chat-forward).
 {SENT_VIA}'''
         
-        final_result = await safe_send_message(client, 'me', final_message, link_preview=False)
-        
+        final_result = await to_saved_messages(
+            pool, lambda sender: safe_send_message(sender, 'me', final_message, link_preview=False))
+
         if final_result is None:
             logger.warning('Failed to send final completion message')
 
+        # Keep forwarding new messages as they arrive
+        if daemon:
+            async with Shutdown():
+                await run_daemon(pool, forwards, forward_pair)
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--daemon', action='store_true', help='keep running and forward new messages as they arrive')
+    parser.add_argument('--plan', action='store_true', help='only estimate messages, requests and time per section')
+    args = parser.parse_args()
+
     assert forwards, "No forwards configured in config.ini"
-    
+
     try:
-        asyncio.run(forward_job())
+        if args.plan:
+            # safe.py copies every message or album, one request each
+            asyncio.run(plan_job(limiter, max_flood_wait=CONFIG['MAX_FLOOD_WAIT']))
+        else:
+            asyncio.run(forward_job(daemon=args.daemon))
     except KeyboardInterrupt:
         logger.info('Script interrupted by user')
     except Exception as err:
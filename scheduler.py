@@ -0,0 +1,152 @@
+''' Run the config.ini forward pairs concurrently under a shared scheduler. '''
+
+import asyncio
+import contextlib
+import logging
+
+from settings import MAX_CONCURRENT_PAIRS, PER_DESTINATION_LIMIT, get_forward, get_share
+from floodledger import current_pair
+from pipeline import fan_out
+from peers import resolve
+from filters import section_filter
+import metrics
+from sessionpool import account_of
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_source(forwards) -> list:
+    """Group the sections that read the same `from` chat, keeping config.ini order"""
+    groups = {}
+    for forward in forwards:
+        from_chat, _, _ = get_forward(forward)
+        groups.setdefault(str(from_chat), []).append(forward)
+    return list(groups.values())
+
+
+def split_by_destination(group) -> list:
+    """Split a group of sections so that no two sections of a part write to the same `to` chat"""
+    parts = []
+    for forward in group:
+        to_chat = str(get_forward(forward)[1])
+        for part in parts:
+            if all(str(get_forward(other)[1]) != to_chat for other in part):
+                part.append(forward)
+                break
+        else:
+            parts.append([forward])
+    return parts
+
+
+def new_limits() -> tuple:
+    """The MAX_CONCURRENT_PAIRS semaphore and the per-destination semaphores of run_pairs, for sharing"""
+    return asyncio.Semaphore(max(1, MAX_CONCURRENT_PAIRS)), {}
+
+
+async def run_pairs(forwards, forward_pair, pool, limits=None):
+    """
+    Run `forward_pair(client, forward)` for every section as its own asyncio task.
+
+    Sections that read the same `from` chat and write to different `to`
+    chats run together on one account, and those with the same filters
+    share a single history fetch (see pipeline.fan_out), starting at their
+    smallest offset; each still keeps its own offset.
+
+    At most MAX_CONCURRENT_PAIRS of these groups run at the same time, and
+    at most PER_DESTINATION_LIMIT sections write to the same `to` chat.
+    Every section still forwards its own messages in order, and a flood
+    wait in one section only sleeps that section's task. A section that
+    raises does not stop the others; the first error is raised once they
+    are all done.
+
+    Args:
+        forwards: Section names from config.ini
+        forward_pair: Async function taking a client and a section name and returning its report
+        pool: The SessionPool handing out accounts
+        limits: The limits of another run_pairs call to share, from new_limits(); by default
+            the limits only cover this call
+
+    Returns:
+        The reports of all sections, in config.ini order
+    """
+    global_limit, destination_limits = limits or new_limits()
+    reports = {}
+
+    async def run_one(client, forward, sources):
+        # Every section runs in its own task, so this only tags this section's flood waits and account turns
+        current_pair.set(forward)
+        started = asyncio.get_running_loop().time()
+        try:
+            reports[forward] = await forward_pair(client, forward)
+        finally:
+            metrics.count(forward, 'active_ms', int((asyncio.get_running_loop().time() - started) * 1000))
+            for source in sources:
+                source.leave(forward)
+
+    async def run(group):
+        chats = [get_forward(forward) for forward in group]
+        destinations = sorted({str(to_chat) for _, to_chat, _ in chats})
+        async with contextlib.AsyncExitStack() as stack:
+            # Wait for the destinations first (in a fixed order) so a blocked source does not hold a global slot
+            for destination in destinations:
+                await stack.enter_async_context(destination_limits.setdefault(
+                    destination, asyncio.Semaphore(max(1, PER_DESTINATION_LIMIT))))
+            await stack.enter_async_context(global_limit)
+
+            client = await pool.acquire()
+            stack.callback(pool.release, client)
+            logger.info('Scheduler started %s on %s', ', '.join(group), account_of(client))
+            sources = []
+            if len(group) > 1:
+                from_peer = await resolve(client, chats[0][0])
+                readers = {}  # filter key -> (Filter, offsets of the sections using it)
+                for forward, (_, _, offset) in zip(group, chats):
+                    spec = section_filter(forward)
+                    readers.setdefault(spec.key if spec else (), (spec, []))[1].append(offset)
+                for spec, offsets in readers.values():
+                    if len(offsets) > 1:
+                        sources.append(stack.enter_context(
+                            fan_out(client, from_peer, min(offsets), len(offsets), spec)))
+            return await asyncio.gather(*(run_one(client, forward, sources) for forward in group),
+                                        return_exceptions=True)
+
+    # Sections of one source writing to the same `to` chat are separate groups, so each counts against its limit
+    groups = [part for group in group_by_source(forwards) for part in split_by_destination(group)]
+    # Higher priorities take the free slots first
+    groups.sort(key=lambda group: -max(get_share(f)[0] for f in group))
+    results = await asyncio.gather(*(run(group) for group in groups), return_exceptions=True)
+    for result in results:
+        # run() itself failed (resolving the source), or a section did
+        for error in result if isinstance(result, list) else [result]:
+            if isinstance(error, BaseException):
+                raise error
+    return [reports[forward] for forward in forwards]
+
+
+def fairness(forwards) -> list:
+    """
+    Summary lines on how the sections shared their accounts.
+
+    Every section gets its messages, throughput and average wait for an
+    account turn. Every send that several sections were waiting for was
+    owed to the waiting sections of the highest priority, in proportion to
+    their weights (see ratelimit.FairLock); the share of its owed sends a
+    section got is listed, and Jain's index over those shares sums it up:
+    1.00 when every section got exactly its weighted share.
+    """
+    lines, shares = [], []
+    for forward in forwards:
+        counters = metrics.pair_counters[forward]
+        priority, weight = get_share(forward)
+        minutes = counters['active_ms'] / 60000
+        rate = counters['forwarded'] / minutes if minutes else 0
+        waited = counters['wait_ms'] / counters['sends'] / 1000 if counters['sends'] else 0
+        line = f'- {forward}: {counters["forwarded"]} messages, {rate:.0f}/min, {waited:.1f}s average wait'
+        if counters['owed_turns'] >= 1:
+            shares.append(counters['shared_turns'] / counters['owed_turns'])
+            line += f', {shares[-1]:.0%} of its share of the sends'
+        lines.append(f'{line} (priority {priority}, weight {weight:g})')
+    if len(shares) > 1:
+        index = sum(shares) ** 2 / (len(shares) * sum(share ** 2 for share in shares))
+        lines.append(f'Fairness: {index:.2f} (1.00 = every section got its weighted share)')
+    return lines
@@ -0,0 +1,117 @@
+''' A pool of logged-in accounts that share the forward sections between them. '''
+
+import asyncio
+import contextvars
+import logging
+import time
+
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+
+from settings import STRING_SESSION, STRING_SESSIONS
+from floodledger import account_deadline
+
+logger = logging.getLogger(__name__)
+
+# Account name (user id) of every pooled client, and until when (time.time()) each account is flood-waited
+_accounts = {}
+_flooded_until = {}
+
+# Set while RateLimiter.call runs a request, so every flood wait of that request is raised to it
+paced = contextvars.ContextVar('paced', default=False)
+
+# Flood waits Telethon still sleeps through inside requests the rate limiter does not pace (seconds)
+UNPACED_FLOOD_SLEEP = 60
+
+
+class Client(TelegramClient):
+    """
+    A TelegramClient that sleeps through no flood wait of a paced request.
+
+    Clients are built with flood_sleep_threshold=0, so every FloodWaitError
+    of a request made through RateLimiter.call reaches the limiter, which
+    learns from the short waits too. The other requests (history reads,
+    resolving chats, media transfers) have no retry of their own, so
+    Telethon keeps sleeping through their waits of up to
+    UNPACED_FLOOD_SLEEP seconds.
+    """
+
+    @property
+    def flood_sleep_threshold(self):
+        return self._flood_sleep_threshold if paced.get() else max(self._flood_sleep_threshold, UNPACED_FLOOD_SLEEP)
+
+    @flood_sleep_threshold.setter
+    def flood_sleep_threshold(self, value):
+        self._flood_sleep_threshold = min(value or 0, 24 * 60 * 60)
+
+
+def account_of(client) -> str:
+    """Return the pool name of `client` ('default' for clients outside a pool)"""
+    return _accounts.get(id(client), 'default')
+
+
+def mark_flooded(account: str, seconds: int) -> None:
+    """Take `account` out of rotation until its flood wait is over"""
+    _flooded_until[account] = max(_flooded_until.get(account, 0), time.time() + seconds)
+
+
+def build_sessions() -> list:
+    """Sessions from STRING_SESSIONS, else STRING_SESSION, else the 'forwarder' session file"""
+    if STRING_SESSIONS:
+        return [StringSession(session) for session in STRING_SESSIONS]
+    return [StringSession(STRING_SESSION) if STRING_SESSION else 'forwarder']
+
+
+class SessionPool:
+    """
+    Starts one TelegramClient per session and hands each forward section to an account.
+
+    A section runs on a single account from start to end, so its messages stay
+    in order. New sections go to the healthy account running the fewest
+    sections. Accounts that hit a FloodWaitError are skipped until the wait is
+    over. If every account is flood-waited, the pool waits for the first one
+    to become free.
+    """
+
+    def __init__(self, sessions, api_id: int, api_hash: str):
+        self.clients = [Client(session, api_id, api_hash, flood_sleep_threshold=0) for session in sessions]
+        self.running = {}
+
+    @property
+    def main(self):
+        """The first account, used for the summary sent to 'me'"""
+        return self.clients[0]
+
+    async def __aenter__(self):
+        for client in self.clients:
+            await client.start()
+            # Learned rates and flood deadlines are stored under this name, so it has to follow the account
+            # rather than its place in STRING_SESSIONS
+            me = await client.get_me(input_peer=True)
+            _accounts[id(client)] = f'user{me.user_id}'
+            self.running[id(client)] = 0
+            # Flood waits from earlier runs still apply
+            mark_flooded(account_of(client), account_deadline(account_of(client)) - time.time())
+        logger.info(f'Session pool started with {len(self.clients)} account(s)')
+        return self
+
+    async def __aexit__(self, *args):
+        for client in self.clients:
+            await client.disconnect()
+            _accounts.pop(id(client), None)
+
+    async def acquire(self):
+        """Return the least busy account that is not flood-waited"""
+        while True:
+            now = time.time()
+            healthy = [c for c in self.clients if _flooded_until.get(account_of(c), 0) <= now]
+            if healthy:
+                client = min(healthy, key=lambda c: self.running[id(c)])
+                self.running[id(client)] += 1
+                return client
+            wait = min(_flooded_until[account_of(c)] for c in self.clients) - now
+            logger.warning(f'All accounts are flood-waited, waiting {wait:.0f} seconds')
+            await asyncio.sleep(wait)
+
+    def release(self, client) -> None:
+        self.running[id(client)] -= 1
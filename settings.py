@@ -1,27 +1,89 @@
 from configparser import ConfigParser
 from dotenv import load_dotenv
+import atexit
+import io
 import os
 import logging
 
+from checkpoint import CheckpointStore
+
 load_dotenv()
 
 API_ID = os.getenv('api_id')
 API_HASH = os.getenv('api_hash')
 STRING_SESSION = os.getenv('STRING_SESSION')
+# Optional: several StringSessions separated by commas, to share the work between accounts
+STRING_SESSIONS = [session.strip() for session in os.getenv('STRING_SESSIONS', '').split(',') if session.strip()]
+
+# How many config.ini sections may run at the same time, in total and per destination
+MAX_CONCURRENT_PAIRS = int(os.getenv('MAX_CONCURRENT_PAIRS', '1'))
+PER_DESTINATION_LIMIT = int(os.getenv('PER_DESTINATION_LIMIT', '1'))
+
+# History is fetched PAGE_SIZE messages per request, up to PREFETCH_PAGES pages ahead of the sender
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '100'))
+PREFETCH_PAGES = int(os.getenv('PREFETCH_PAGES', '4'))
+# Channel history older than the start of a run is fetched FETCH_SHARDS pages at a time, in parallel (1 = off)
+FETCH_SHARDS = int(os.getenv('FETCH_SHARDS', '1'))
+
+# In --daemon mode, every source is also checked this often (seconds) in case an update was missed
+DAEMON_POLL_INTERVAL = float(os.getenv('DAEMON_POLL_INTERVAL', '300'))
+
+# Optional: skip content (same media file or same text) already sent to a destination
+DEDUP = os.getenv('DEDUP', '').lower() in ('1', 'true', 'yes')
+DEDUP_FILE = os.getenv('DEDUP_FILE', 'dedup.db')
+DEDUP_EXPECTED = int(os.getenv('DEDUP_EXPECTED', '1000000'))  # entries the in-memory filter is sized for
+
+# Optional metrics: a Prometheus /metrics port, a JSON snapshot file written every METRICS_INTERVAL seconds,
+# and a JSON-lines file with one trace span per request
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '30'))
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+# Log every Nth forwarded message at INFO (0 = no per-message lines)
+MESSAGE_LOG_EVERY = int(os.getenv('MESSAGE_LOG_EVERY', '0'))
+
+# archive.py keeps exported history here; ARCHIVE_MEDIA=false archives the messages without their files
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_MEDIA = os.getenv('ARCHIVE_MEDIA', 'true').lower() in ('1', 'true', 'yes')
+
+# Copies of protected media are downloaded and re-uploaded by at most MEDIA_WORKERS transfers at once,
+# each uploading UPLOAD_PARTS_IN_FLIGHT parts in parallel
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '4'))
+UPLOAD_PARTS_IN_FLIGHT = int(os.getenv('UPLOAD_PARTS_IN_FLIGHT', '4'))
+
+# Every MEMORY_INTERVAL seconds Telethon's entity caches are trimmed and RSS is logged (0 = never)
+MEMORY_INTERVAL = float(os.getenv('MEMORY_INTERVAL', '60'))
+
+# Resolved chats are cached (in CHECKPOINT_FILE) for this many seconds before being resolved again
+PEER_CACHE_TTL = float(os.getenv('PEER_CACHE_TTL', '86400'))
+
+# Offsets are saved here in batches instead of rewriting config.ini after every message
+CHECKPOINT_FILE = os.getenv('CHECKPOINT_FILE', 'checkpoints.db')
+CHECKPOINT_BATCH = int(os.getenv('CHECKPOINT_BATCH', '50'))
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '5'))
+
+# After SIGINT or SIGTERM, sends in flight get this many seconds to finish before they are cancelled
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '20'))
 
 assert API_ID and API_HASH
 
-configur = ConfigParser()
+configur = ConfigParser(inline_comment_prefixes=(';',))
 configur.read('config.ini')
 
-forwards = configur.sections()
+# Optional: only forward these sections (comma separated); check_flood_wait.py uses it to resume deferred ones
+FORWARD_SECTIONS = [section.strip() for section in os.getenv('FORWARD_SECTIONS', '').split(',') if section.strip()]
+
+forwards = [section for section in configur.sections() if not FORWARD_SECTIONS or section in FORWARD_SECTIONS]
+
+checkpoints = CheckpointStore(CHECKPOINT_FILE, CHECKPOINT_BATCH, CHECKPOINT_INTERVAL)
+atexit.register(checkpoints.flush)
 
 
 def get_forward(forward: str) -> tuple:
     try:
         from_chat = configur.get(forward, 'from')
         to_chat = configur.get(forward, 'to')
-        offset = configur.getint(forward, 'offset')
+        offset = checkpoints.get(forward, configur.getint(forward, 'offset'))
         return from_chat, to_chat, offset
     except Exception as err:
         logging.exception(
@@ -29,11 +91,41 @@ def get_forward(forward: str) -> tuple:
         quit()
 
 
+def get_share(forward: str) -> tuple:
+    """The (priority, weight) of a section's requests on a shared account; (0, 1) unless config.ini sets them"""
+    if forward is None or not configur.has_section(forward):
+        return 0, 1.0
+    try:
+        priority = configur.getint(forward, 'priority', fallback=0)
+        weight = configur.getfloat(forward, 'weight', fallback=1.0)
+        assert weight > 0, 'weight must be above 0'
+        return priority, weight
+    except Exception as err:
+        logging.exception(
+            'The priority or weight of %s is not valid. See the README.md file for more details. \n\n %s', forward, str(err))
+        quit()
+
+
+def saved_config() -> bytes:
+    """
+    config.ini with the saved offset of every section in place of its own, for the backup sent to 'me'.
+
+    Offsets are kept in checkpoints.db, so the file on disk does not have
+    them. Restored, this copy resumes every section where the run left
+    off, with or without checkpoints.db. Comments are not kept.
+    """
+    backup = ConfigParser(inline_comment_prefixes=(';',))
+    backup.read_dict(configur)
+    for forward in forwards:
+        backup[forward]['offset'] = str(get_forward(forward)[2])
+    text = io.StringIO()
+    backup.write(text)
+    return text.getvalue().encode()
+
+
 def update_offset(forward: str, new_offset: str) -> None:
     try:
-        configur.set(forward, 'offset', new_offset)
-        with open('config.ini', 'w') as cfg:
-            configur.write(cfg)
+        checkpoints.set(forward, int(new_offset), configur.getint(forward, 'offset'))
     except Exception as err:
         logging.exception(
             'Problem occured while updating offset of %s \n\n %s', forward, str(err))
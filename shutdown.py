@@ -0,0 +1,165 @@
+''' Stop on Ctrl-C or SIGTERM without losing or repeating a message. '''
+
+import asyncio
+import logging
+import signal
+
+from telethon import utils
+from telethon.tl.patched import MessageService
+
+from settings import SHUTDOWN_TIMEOUT, checkpoints, get_forward, update_offset
+from dedup import dedup
+from filters import media_kinds, section_filter
+
+logger = logging.getLogger(__name__)
+
+CONFIG = {
+    'SEND_SIZE': 100,  # Most messages one send carries (a forward of 100 ids), on top of a checkpoint batch
+    'LOOKBACK': 100,  # Destination messages read beyond the unconfirmed ones when checking them on restart
+}
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+_stopping = False
+
+
+def stopping() -> bool:
+    """True once a signal asked the run to stop: history is no longer handed out for sending"""
+    return _stopping
+
+
+class Shutdown:
+    """
+    While open, SIGINT and SIGTERM stop the run gracefully instead of killing it.
+
+    The first signal stops the history fetch at the end of the current
+    album (see prefetch_messages), so every section finishes the send it
+    has in flight, sets its offset and returns. Whatever still runs
+    SHUTDOWN_TIMEOUT seconds later, or after a second signal, is cancelled.
+    On exit, the offsets and the message map are written in one final
+    checkpoint. A send cut off by the cancellation keeps its in-flight
+    record, which resume() checks on the next run.
+    """
+
+    def __init__(self):
+        self.timer = None
+        self.cancelled = False
+
+    def _signal(self, signum) -> None:
+        global _stopping
+        if _stopping:
+            logger.warning('%s again, cancelling the sends in flight', signal.Signals(signum).name)
+            self._cancel()
+            return
+        _stopping = True
+        logger.warning('%s received, finishing the sends in flight (at most %ss) before stopping',
+                       signal.Signals(signum).name, SHUTDOWN_TIMEOUT)
+        self.timer = self.loop.call_later(SHUTDOWN_TIMEOUT, self._cancel)
+
+    def _cancel(self) -> None:
+        if not self.cancelled:
+            self.cancelled = True
+            self.task.cancel()
+
+    async def __aenter__(self):
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_running_loop()
+        for signum in SIGNALS:
+            try:
+                self.loop.add_signal_handler(signum, self._signal, signum)
+            except NotImplementedError:
+                # Windows event loops have no signal handlers; the handler hands over to the loop instead
+                signal.signal(signum, lambda received, frame: self.loop.call_soon_threadsafe(self._signal, received))
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        for signum in SIGNALS:
+            try:
+                self.loop.remove_signal_handler(signum)
+            except NotImplementedError:
+                signal.signal(signum, signal.default_int_handler if signum == signal.SIGINT else signal.SIG_DFL)
+        if self.timer:
+            self.timer.cancel()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
+        if _stopping:
+            logger.info('Stopped; offsets saved, the next run continues from them')
+        # The cancellation was ours, so the run ends here instead of failing
+        if exc_type is asyncio.CancelledError and self.cancelled:
+            if hasattr(self.task, 'uncancel'):
+                self.task.uncancel()  # Python 3.11+: later awaits of the task are not cancelled again
+            return True
+        return False
+
+
+def _same(source, sent, from_peer) -> bool:
+    """Whether destination message `sent` is the forward or the copy of source message `source`"""
+    header = sent.fwd_from
+    if header and header.channel_post:
+        return header.channel_post == source.id and utils.get_peer_id(header.from_id) == utils.get_peer_id(from_peer)
+    return (sent.message or '') == (source.message or '') and media_kinds(sent) == media_kinds(source)
+
+
+async def resume(client, forward: str, from_peer, to_peer, offset: int) -> int:
+    """
+    The offset to continue `forward` from, after checking the sends the last run did not confirm.
+
+    A run that was killed or cancelled mid-send leaves an in-flight record
+    in the checkpoint (see CheckpointStore): the section may have sent
+    messages after its committed offset, at most a checkpoint batch and
+    one send. Those source messages are read again and matched, in order,
+    against this account's newest messages in the destination after the
+    last mapped one: a forward by its original post id, a copy by its text
+    and kind of media. The matched ones are added to the message map and
+    the dedup index, and the offset moves past the leading run of matched
+    messages, so they are not sent twice and nothing after them is skipped.
+    Only the source messages that pass the section filter are matched,
+    since the others were never sent.
+    """
+    first = checkpoints.unconfirmed(forward)
+    if first is None:
+        return offset
+    first = max(first, offset + 1)
+
+    spec = section_filter(forward)
+    if spec:
+        await spec.params(client)  # Resolves the `sender` filter
+    window = checkpoints.batch_size + CONFIG['SEND_SIZE']
+    sources = []
+    async for message in client.iter_messages(from_peer, min_id=first - 1, reverse=True):
+        if isinstance(message, MessageService) or (spec and not spec.matches(message, everything=True)):
+            continue
+        sources.append(message)
+        if len(sources) >= window:
+            break
+    before = checkpoints.last_destination(forward, first)
+    sent = [m for m in await client.get_messages(to_peer, limit=len(sources) + CONFIG['LOOKBACK'], min_id=before or 0)
+            if m.out]
+    sent.reverse()  # Oldest first, like the sources
+
+    found, position = {}, 0
+    for source in sources:
+        for index in range(position, len(sent)):
+            if _same(source, sent[index], from_peer):
+                found[source.id] = sent[index]
+                position = index + 1
+                break
+
+    _, to_chat, _ = get_forward(forward)
+    for source in sources:
+        if source.id in found:
+            checkpoints.map(forward, source.id, found[source.id].id, copied=not found[source.id].fwd_from)
+            if dedup:
+                dedup.add(to_chat, source)
+    resumed = offset
+    for source in sources:
+        if source.id not in found:
+            break
+        resumed = source.id
+    if resumed > offset:
+        update_offset(forward, str(resumed))
+    logger.info('[%s] The last run stopped without confirming its sends: %s of the %s messages after %s found in %s, '
+                'continuing after %s', forward, len(found), len(sources), first - 1, to_chat, resumed)
+    checkpoints.settle(forward)
+    return resumed
@@ -1,10 +1,23 @@
+import argparse
 import asyncio
 import logging
-from telethon.tl.patched import MessageService
 from telethon.errors.rpcerrorlist import FloodWaitError
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from settings import API_ID, API_HASH, forwards, get_forward, update_offset, STRING_SESSION
+from telethon.tl.types import DocumentAttributeFilename
+from settings import API_ID, API_HASH, forwards, get_forward, update_offset, checkpoints, saved_config
+from scheduler import fairness, run_pairs
+from daemon import run_daemon
+from dedup import dedup
+import metrics
+import memory
+from sessionpool import SessionPool, account_of, build_sessions
+from pipeline import prefetch_messages, iter_chunks, as_message
+from strategy import deliver, protected
+from transfer import pipeline
+from peers import preflight, resolve
+from filters import section_filter
+from planner import plan_job
+from ratelimit import RateLimiter
+from shutdown import Shutdown, resume, stopping
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -13,75 +26,140 @@ logging.basicConfig(
 
 SENT_VIA = f'\n__Sent via__ `{str(__file__)}`'
 
+CONFIG = {
+    'BATCH_SIZE': 100,  # Message ids per forward request (Telegram allows at most 100). Set 1 to forward one by one
+    'INITIAL_RATE': 2,  # Forward requests per second until a rate has been learned - adjustable to reduce flood wait
+}
 
-def intify(string):
-    """Convert string to int if possible, otherwise return string"""
-    try:
-        return int(string)
-    except ValueError:
-        return string
+limiter = RateLimiter(initial_rate=CONFIG['INITIAL_RATE'])
 
 
-async def safe_forward(client, to_chat, message):
-    """Forward a message safely with flood wait handling"""
+async def safe_forward(client, to_chat, from_peer, messages):
+    """Forward a list of messages of `from_peer` safely with flood wait handling"""
+    ids = [m.id for m in messages]
     while True:
         try:
-            return await client.forward_messages(to_chat, message)
+            return await limiter.call(lambda: client.forward_messages(to_chat, ids, from_peer=from_peer), to_chat, 'forward_messages', account_of(client))
         except FloodWaitError as fwe:
             logging.warning(f'Flood wait for forwarding message: {fwe.seconds} seconds')
+            metrics.retry('forward_messages')
+            await asyncio.sleep(fwe.seconds)
+
+
+async def safe_copy(client, from_peer, to_chat, album, reply_to=None):
+    """Send a copy of one message or album, for chats and messages that cannot be forwarded"""
+    if protected(from_peer, album):
+        # Protected media cannot be sent by reference, so it is re-uploaded through the media pipeline
+        media = await pipeline.media(client, album)
+        captions = [m.message or '' for m in album]
+        entities = [m.entities or [] for m in album]
+        if len(album) == 1 and media[0] is None:
+            send = lambda: client.send_message(to_chat, album[0].message, formatting_entities=album[0].entities,
+                                               reply_to=reply_to)
+        elif len(album) == 1:
+            send = lambda: client.send_file(to_chat, media[0], caption=captions[0], formatting_entities=entities[0],
+                                            reply_to=reply_to)
+        else:
+            send = lambda: client.send_file(to_chat, media, caption=captions, formatting_entities=entities,
+                                            reply_to=reply_to)
+    elif len(album) == 1:
+        send = lambda: client.send_message(to_chat, as_message(album[0]), reply_to=reply_to)
+    else:
+        send = lambda: client.send_file(to_chat, [m.media for m in album], caption=[m.message or '' for m in album],
+                                        formatting_entities=[m.entities or [] for m in album], reply_to=reply_to)
+    method = 'send_message' if len(album) == 1 and not album[0].media else 'send_file'
+    while True:
+        try:
+            return await limiter.call(send, to_chat, method, account_of(client))
+        except FloodWaitError as fwe:
+            logging.warning(f'Flood wait for copying message: {fwe.seconds} seconds')
+            metrics.retry(method)
             await asyncio.sleep(fwe.seconds)
 
 
-async def forward_job():
+async def forward_pair(client, forward):
+    """Forward the new messages of one config.ini section and return its offset report"""
+    from_chat, to_chat, offset = get_forward(forward)
+    from_peer, to_peer = await resolve(client, from_chat), await resolve(client, to_chat)
+    # A send the last run could not confirm is looked up in the destination first
+    offset = await resume(client, forward, from_peer, to_peer, offset or 0)
+    initial_offset = offset
+    last_id = 0
+    error_occurred = False
+
+    messages = prefetch_messages(client, from_peer, offset, spec=section_filter(forward))
+    try:
+        async for chunk in iter_chunks(messages, CONFIG['BATCH_SIZE']):
+            fresh = dedup.fresh(to_chat, chunk) if dedup else chunk
+            if len(fresh) < len(chunk):
+                logging.info('Skipped %s messages already sent to %s', len(chunk) - len(fresh), to_chat)
+                metrics.count(forward, 'skipped', len(chunk) - len(fresh))
+            if fresh:
+                checkpoints.begin(forward, fresh[0].id, fresh[-1].id)
+                await deliver(client, from_peer, forward, fresh,
+                              lambda batch: safe_forward(client, to_peer, from_peer, batch),
+                              lambda album, reply_to: safe_copy(client, from_peer, to_peer, album, reply_to),
+                              lambda album: pipeline.prepare(client, album))
+                last_id = fresh[-1].id
+                logging.info('Forwarded messages up to id = %s', last_id)
+                # FIX: convert to string for configparser
+                update_offset(forward, str(last_id))
+                checkpoints.confirm(forward)
+                metrics.count(forward, 'forwarded', len(fresh))
+                if dedup:
+                    for m in fresh:
+                        dedup.add(to_chat, m)
+            # Skipped messages at the end of the chunk still move the offset
+            if last_id != chunk[-1].id:
+                last_id = chunk[-1].id
+                update_offset(forward, str(last_id))
+
+    except Exception as err:
+        logging.exception(err)
+        metrics.count(forward, 'failed')
+        error_occurred = True
+
+    logging.info('Completed forward job for %s', forward)
+    # Record final offset for this mapping (last_id if forwarded, else initial)
+    final_offset = last_id if last_id > 0 else initial_offset
+    return {
+        'from': from_chat,
+        'to': to_chat,
+        'final_offset': final_offset,
+        'error': error_occurred
+    }
+
+
+async def forward_job(daemon: bool = False):
     """Main forwarding function"""
-    session = StringSession(STRING_SESSION) if STRING_SESSION else 'forwarder'
+    sessions = build_sessions()  # one session per account
     assert API_ID is not None and API_HASH is not None, "API_ID and API_HASH must be set"
 
-    async with TelegramClient(session, int(API_ID), str(API_HASH)) as client:
+    async with SessionPool(sessions, int(API_ID), str(API_HASH)) as pool, metrics.Exporter(), memory.Monitor(pool):
+        client = pool.main
 
         confirm = '''IMPORTANT 🛑
 Your `config.ini` must be correct. Check chat IDs with @userinfobot.
 Press [ENTER] to continue:'''
         input(confirm)
 
-        error_occurred = False
-        offset_reports = []  # Collect per-forward final offsets for the summary
-
-        for forward in forwards:
-            from_chat, to_chat, offset = get_forward(forward)
-            offset = offset or 0
-            initial_offset = offset
-            last_id = 0
-
-            async for message in client.iter_messages(intify(from_chat), reverse=True, offset_id=offset):
-                if isinstance(message, MessageService):
-                    continue
-
-                try:
-                    await safe_forward(client, intify(to_chat), message)
-                    last_id = message.id
-                    logging.info('Forwarded message id = %s', last_id)
-                    # FIX: convert to string for configparser
-                    update_offset(forward, str(last_id))
-                    await asyncio.sleep(0.5)  # Adjustable delay to reduce flood wait
-
-                except Exception as err:
-                    logging.exception(err)
-                    error_occurred = True
-                    break
-
-            logging.info('Completed forward job for %s', forward)
-            # Record final offset for this mapping (last_id if forwarded, else initial)
-            final_offset = last_id if last_id > 0 else initial_offset
-            offset_reports.append({
-                'from': from_chat,
-                'to': to_chat,
-                'final_offset': final_offset
-            })
-
-        # Send config file safely
+        await preflight(pool, forwards)
+        async with Shutdown():
+            offset_reports = await run_pairs(forwards, forward_pair, pool)
+        if stopping():
+            limiter.save()
+            return
+        error_occurred = any(r['error'] for r in offset_reports)
+        limiter.save()
+        checkpoints.flush()
+        if dedup:
+            dedup.flush()
+
+        # Send config.ini with the saved offsets safely
         try:
-            await client.send_file('me', 'config.ini', caption='Your config file for telegram-chat-forward.')
+            await client.send_file('me', saved_config(), attributes=[DocumentAttributeFilename('config.ini')],
+                                   force_document=True,
+                                   caption='Your config file for telegram-chat-forward, with the saved offsets.')
         except Exception as err:
             logging.error(f'Failed to send config file: {err}')
 
@@ -91,12 +169,18 @@ Press [ENTER] to continue:'''
         else:
             lines = [f"- {r['from']} → {r['to']}: {r['final_offset']}" for r in offset_reports]
             offset_summary_text = "Your offset numbers:\n" + "\n".join(lines)
+            # How the sections shared the accounts
+            share_lines = fairness(forwards)
+            for line in share_lines:
+                logging.info(line)
+            offset_summary_text += "\n\nSections:\n" + "\n".join(share_lines)
 
         # Send final summary message with offsets
         final_message = f"""
 Hi!
 **{'Your forward job has completed.' if not error_occurred else 'Some errors occurred. Check terminal output.'}**
 {offset_summary_text}
+The offsets are saved in checkpoints.db, and the next run resumes from them. The config.ini above has them too, to resume on another machine. To start a section from another message, change its offset in config.ini.
 **Telegram Chat Forward** is developed by OpenSource Dev.
 Please star 🌟 on [GitHub](https://github.com/its-anya/telegram-all-forward).
 {SENT_VIA}
@@ -106,7 +190,20 @@ Please star 🌟 on [GitHub](https://github.com/its-anya/telegram-all-forward).
         except Exception as err:
             logging.error(f'Failed to send final message: {err}')
 
+        # Keep forwarding new messages as they arrive
+        if daemon:
+            async with Shutdown():
+                await run_daemon(pool, forwards, forward_pair)
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Forward all messages with server-side forwarding.')
+    parser.add_argument('--daemon', action='store_true', help='keep running and forward new messages as they arrive')
+    parser.add_argument('--plan', action='store_true', help='only estimate messages, requests and time per section')
+    args = parser.parse_args()
+
     assert forwards, "No forwards configured in settings.py"
-    asyncio.run(forward_job())
+    if args.plan:
+        asyncio.run(plan_job(limiter, CONFIG['BATCH_SIZE']))
+    else:
+        asyncio.run(forward_job(daemon=args.daemon))
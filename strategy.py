@@ -0,0 +1,193 @@
+''' Pick server-side forwarding or copying per chat and per message, and remember what each chat allows. '''
+
+import logging
+import sqlite3
+import time
+
+from telethon import utils
+from telethon.errors.rpcerrorlist import ChatForwardsRestrictedError, FloodWaitError
+
+from settings import CHECKPOINT_FILE, checkpoints
+from pipeline import reply_id
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RECHECK_AFTER = 24 * 3600  # Seconds before a stored answer of a chat is checked again
+
+
+class Capabilities:
+    """
+    Whether each source chat allows forwarding, stored next to the offsets.
+
+    A chat is looked up once: its `noforwards` flag is read from the entity,
+    or learned from the first ChatForwardsRestrictedError. Later runs reuse
+    the stored answer instead of asking again, until it is RECHECK_AFTER
+    seconds old, so a daemon notices a chat that changed its setting.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS chat_capabilities ('
+            'chat TEXT PRIMARY KEY, forwardable INTEGER NOT NULL, checked REAL NOT NULL)'
+        )
+        self.db.commit()
+        self.known = {}
+        self.checked = {}
+        for chat, forwardable, checked in self.db.execute('SELECT chat, forwardable, checked FROM chat_capabilities'):
+            self.known[chat] = bool(forwardable)
+            self.checked[chat] = checked
+
+    def set(self, chat, forwardable: bool) -> None:
+        before = self.known.get(_key(chat))
+        self.known[_key(chat)] = forwardable
+        self.checked[_key(chat)] = time.time()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO chat_capabilities VALUES (?, ?, ?)',
+                            (_key(chat), int(forwardable), self.checked[_key(chat)]))
+        if before is not False and not forwardable:
+            logger.info(f'Forwarding from {chat} is restricted, copying its messages instead')
+        elif before is False and forwardable:
+            logger.info(f'Forwarding from {chat} is allowed again, forwarding its messages')
+
+    async def forwardable(self, client, chat) -> bool:
+        """True if messages of `chat` may be forwarded, checking the chat again once the answer is stale"""
+        if time.time() - self.checked.get(_key(chat), 0) > RECHECK_AFTER:
+            try:
+                entity = await client.get_entity(chat)
+            except Exception as err:
+                # Unknown for now, or keep the old answer; the first forward will tell
+                logger.debug(f'Could not check whether {chat} allows forwarding: {err}')
+                if _key(chat) in self.known:
+                    self.checked[_key(chat)] = time.time()
+                return self.known.get(_key(chat), True)
+            self.set(chat, not getattr(entity, 'noforwards', False))
+        return self.known[_key(chat)]
+
+
+def _key(chat) -> str:
+    # The marked id of a resolved peer is the same for every account
+    try:
+        return str(utils.get_peer_id(chat))
+    except (TypeError, ValueError):
+        return str(chat)
+
+
+capabilities = Capabilities(CHECKPOINT_FILE)
+
+
+def protected(chat, album) -> bool:
+    """True if `album` cannot be sent by reference and its media has to be re-uploaded"""
+    return capabilities.known.get(_key(chat)) is False or any(m.noforwards for m in album)
+
+
+def split_albums(messages) -> list:
+    """Split a list of messages back into albums (runs of the same grouped_id)"""
+    albums = []
+    for message in messages:
+        if albums and message.grouped_id and albums[-1][-1].grouped_id == message.grouped_id:
+            albums[-1].append(message)
+        else:
+            albums.append([message])
+    return albums
+
+
+def remember(forward, messages, sent, copied: bool) -> None:
+    """Map the source ids of `messages` to the sent message(s) Telegram returned for them"""
+    if sent is None:
+        return
+    if not isinstance(sent, list):
+        sent = [sent]
+    for message, result in zip(messages, sent):
+        if result is not None:
+            checkpoints.map(forward, message.id, result.id, copied)
+
+
+def reply_target(forward, message):
+    """The destination id a copy of `message` should reply to, or None"""
+    source = reply_id(message)
+    if not source:
+        return None
+    target = checkpoints.destination(forward, source)
+    return target[0] if target else None
+
+
+async def _copy(forward, album, copy_album) -> None:
+    remember(forward, album, await copy_album(album, reply_target(forward, album[0])), copied=True)
+    metrics.count(forward, 'copied', len(album))
+
+
+async def deliver(client, from_chat, forward, messages, forward_batch, copy_album, prepare=None,
+                  copy_only: bool = False) -> None:
+    """
+    Send `messages` of `from_chat` to the destination in order, as cheaply as allowed.
+
+    Messages go out with one server-side `forward_batch(messages)` request,
+    which re-uploads nothing. If the chat restricts forwarding, it is
+    remembered and its messages are copied album by album with
+    `copy_album(album, reply_to)`. Protected messages are always copied. If a batch
+    fails for another reason, it is split in half and retried, and only an
+    album that still fails on its own is copied. Flood waits are left to the
+    callables. Before protected albums are copied one by one, `prepare(album)`
+    is called for all of them, so their media can transfer in the background.
+    With `copy_only`, everything is copied and nothing is recorded about the
+    source chat, which may be unreachable.
+
+    The destination id of every sent message is saved in the section's
+    message map. A copy of a reply gets `reply_to` set to the destination id
+    of the message it replies to, if that was sent.
+
+    Args:
+        client: The client sending the messages
+        from_chat: The source chat, whose capability is looked up and recorded
+        forward: The config.ini section, for the metrics
+        messages: Non-service messages, oldest first, with albums kept whole
+        forward_batch: Async function forwarding a list of messages and returning the sent messages
+        copy_album: Async function sending a copy of one album as a reply to `reply_to` (or None),
+            and returning the sent message(s)
+        prepare: Optional function starting the media transfers of an album that is about to be copied
+        copy_only: Copy every album without trying to forward
+    """
+    if not messages:
+        return
+    if copy_only or not await capabilities.forwardable(client, from_chat):
+        albums = split_albums(messages)
+        for album in albums if prepare else ():
+            prepare(album)
+        for album in albums:
+            await _copy(forward, album, copy_album)
+        return
+    if any(m.noforwards for m in messages):
+        # Forward the runs between protected albums, copy the protected ones
+        run = []
+        albums = split_albums(messages)
+        for album in albums if prepare else ():
+            if protected(from_chat, album):
+                prepare(album)
+        for album in albums:
+            if any(m.noforwards for m in album):
+                await deliver(client, from_chat, forward, run, forward_batch, copy_album, prepare)
+                run = []
+                await _copy(forward, album, copy_album)
+            else:
+                run.extend(album)
+        await deliver(client, from_chat, forward, run, forward_batch, copy_album, prepare)
+        return
+    try:
+        remember(forward, messages, await forward_batch(messages), copied=False)
+    except ChatForwardsRestrictedError:
+        capabilities.set(from_chat, False)
+        await deliver(client, from_chat, forward, messages, forward_batch, copy_album, prepare)
+    except FloodWaitError:
+        raise
+    except Exception as err:
+        albums = split_albums(messages)
+        if len(albums) == 1:
+            logger.warning(f'Forwarding message {messages[-1].id} failed ({err}), sending a copy')
+            await _copy(forward, messages, copy_album)
+            return
+        middle = len(albums) // 2
+        logger.warning(f'Forwarding {len(messages)} messages failed ({err}), retrying in two halves')
+        await deliver(client, from_chat, forward, [m for a in albums[:middle] for m in a], forward_batch, copy_album, prepare)
+        await deliver(client, from_chat, forward, [m for a in albums[middle:] for m in a], forward_batch, copy_album, prepare)
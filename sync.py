@@ -0,0 +1,152 @@
+''' Apply the edits and deletions made in the source chats since the last run to what was already sent. '''
+
+import asyncio
+import logging
+import sqlite3
+import time
+
+from telethon import utils
+from telethon.errors.rpcerrorlist import FloodWaitError, MessageNotModifiedError
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.updates import GetChannelDifferenceRequest
+from telethon.tl.types import (
+    ChannelMessagesFilterEmpty, InputPeerChannel, MessageMediaWebPage, UpdateDeleteChannelMessages,
+    UpdateEditChannelMessage)
+from telethon.tl.types.updates import ChannelDifferenceEmpty, ChannelDifferenceTooLong
+
+from settings import CHECKPOINT_FILE, checkpoints, get_forward
+from scheduler import group_by_source
+from sessionpool import account_of
+from peers import resolve
+from ratelimit import RateLimiter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Edits and deletions are cheap requests, but each one is a write to the destination
+limiter = RateLimiter(initial_rate=2)
+
+_db = sqlite3.connect(CHECKPOINT_FILE)
+_db.execute('CREATE TABLE IF NOT EXISTS sync_state (chat INTEGER PRIMARY KEY, pts INTEGER NOT NULL, updated REAL NOT NULL)')
+_db.commit()
+
+
+def _get_pts(chat: int):
+    row = _db.execute('SELECT pts FROM sync_state WHERE chat = ?', (chat,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_pts(chat: int, pts: int) -> None:
+    with _db:
+        _db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)', (chat, pts, time.time()))
+
+
+async def _call(client, destination, method: str, request):
+    """Run one edit or delete request through the rate limiter, sitting out flood waits"""
+    while True:
+        try:
+            return await limiter.call(request, destination, method, account_of(client))
+        except FloodWaitError as fwe:
+            logger.warning(f'Flood wait for {method}: {fwe.seconds} seconds')
+            metrics.retry(method)
+            await asyncio.sleep(fwe.seconds)
+
+
+async def changes(client, channel, pts: int) -> tuple:
+    """
+    The edits and deletions in `channel` after `pts`.
+
+    Telegram returns only what changed (GetChannelDifference), so this costs
+    one request per batch of changes, whatever the size of the history.
+
+    Returns:
+        ({message id: edited message}, {deleted message ids}, the new pts)
+    """
+    edits, deleted = {}, set()
+    while True:
+        difference = await client(GetChannelDifferenceRequest(
+            channel=channel, filter=ChannelMessagesFilterEmpty(), pts=pts, limit=1000, force=True))
+        if isinstance(difference, ChannelDifferenceEmpty):
+            return edits, deleted, difference.pts
+        if isinstance(difference, ChannelDifferenceTooLong):
+            logger.warning('Too many changes since the last sync; older edits and deletions are not applied')
+            return edits, deleted, difference.dialog.pts
+        for update in difference.other_updates:
+            if isinstance(update, UpdateEditChannelMessage):
+                edits[update.message.id] = update.message
+            elif isinstance(update, UpdateDeleteChannelMessages):
+                deleted.update(update.messages)
+                for message_id in update.messages:
+                    edits.pop(message_id, None)
+        pts = difference.pts
+        if difference.final:
+            return edits, deleted, pts
+
+
+async def _apply(client, forward: str, edits: dict, deleted: set) -> None:
+    """Edit and delete the messages one section sent for the changed source messages"""
+    _, to_chat, _ = get_forward(forward)
+    to_peer = await resolve(client, to_chat)
+    for source, message in edits.items():
+        target = checkpoints.destination(forward, source)
+        if not target:
+            continue  # Not sent yet; it goes out edited
+        destination, copied = target
+        if not copied:
+            # Telegram does not allow editing a forwarded message
+            metrics.count(forward, 'edit_skipped')
+            continue
+        try:
+            await _call(client, to_peer, 'edit_message', lambda: client.edit_message(
+                to_peer, destination, message.message, formatting_entities=message.entities,
+                link_preview=isinstance(message.media, MessageMediaWebPage)))
+            metrics.count(forward, 'edited')
+        except MessageNotModifiedError:
+            pass
+    sent = {source: target[0] for source in deleted if (target := checkpoints.destination(forward, source))}
+    ids = list(sent.values())
+    for start in range(0, len(ids), 100):
+        await _call(client, to_peer, 'delete_messages',
+                    lambda batch=ids[start:start + 100]: client.delete_messages(to_peer, batch))
+    checkpoints.forget(forward, list(sent))
+    metrics.count(forward, 'deleted', len(ids))
+    if edits or sent:
+        logger.info(f'Synced {forward}: {len(edits)} edit(s) and {len(sent)} deletion(s) in the source')
+
+
+async def sync_group(client, group) -> None:
+    """Apply the changes of one source chat to every section that reads it"""
+    from_chat, _, _ = get_forward(group[0])
+    peer = await resolve(client, from_chat)
+    if not isinstance(peer, InputPeerChannel):
+        logger.info(f'{from_chat} is not a channel or supergroup; only those can be synced')
+        return
+    chat = utils.get_peer_id(peer)
+    channel = utils.get_input_channel(peer)
+    pts = _get_pts(chat)
+    if pts is None:
+        # First sync of this chat: changes are tracked from now on
+        full = await client(GetFullChannelRequest(channel))
+        _set_pts(chat, full.full_chat.pts)
+        logger.info(f'Tracking edits and deletions in {from_chat} from now on')
+        return
+    edits, deleted, pts = await changes(client, channel, pts)
+    checkpoints.flush()
+    for forward in group:
+        await _apply(client, forward, edits, deleted)
+    # Only move on once every section is up to date, so a crash repeats the changes instead of losing them
+    _set_pts(chat, pts)
+
+
+async def run_sync(pool, forwards) -> None:
+    """Sync the edits and deletions of every `from` chat to the messages already sent from it"""
+    for group in group_by_source(forwards):
+        client = await pool.acquire()
+        try:
+            await sync_group(client, group)
+        except Exception as err:
+            logger.exception(f'Syncing {", ".join(group)} failed: {err}')
+        finally:
+            pool.release(client)
+    checkpoints.flush()
+    limiter.save()
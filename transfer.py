@@ -0,0 +1,146 @@
+''' Download and re-upload media for copies through a bounded pool of concurrent transfers. '''
+
+import asyncio
+import collections
+import logging
+import os
+import random
+import tempfile
+import time
+
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import (
+    InputFile, InputFileBig, InputMediaUploadedDocument, InputMediaUploadedPhoto, MessageMediaDocument, MessageMediaPhoto)
+
+from settings import MEDIA_WORKERS, UPLOAD_PARTS_IN_FLIGHT
+from sessionpool import account_of
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024  # The largest upload part Telegram accepts
+BIG_FILE = 10 * 1024 * 1024  # Files above this size must be uploaded as big file parts
+UPLOAD_CACHE = 10000  # Uploaded files remembered for reuse
+UPLOAD_TTL = 60 * 60  # Seconds an upload is reused; Telegram drops uploaded parts after about a day
+
+
+def has_file(message) -> bool:
+    return isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument))
+
+
+async def upload(client, path: str, parts_in_flight: int = UPLOAD_PARTS_IN_FLIGHT):
+    """
+    Upload a file with several parts in flight at once and return its InputFile.
+
+    Telethon's upload_file sends one part after the other; here up to
+    `parts_in_flight` SaveFilePart requests share the connection, so a large
+    file is not bound by the round trip of every part. Parts are read from
+    disk as they are sent, so memory stays at `parts_in_flight` parts.
+    """
+    size = os.path.getsize(path)
+    parts = max(1, (size + PART_SIZE - 1) // PART_SIZE)
+    big = size > BIG_FILE
+    file_id = random.getrandbits(63)
+    queue = iter(range(parts))
+
+    async def worker():
+        with open(path, 'rb') as data:
+            for part in queue:
+                data.seek(part * PART_SIZE)
+                chunk = data.read(PART_SIZE)
+                if big:
+                    await client(SaveBigFilePartRequest(file_id, part, parts, chunk))
+                else:
+                    await client(SaveFilePartRequest(file_id, part, chunk))
+
+    with metrics.timed('upload_file', parts=parts):
+        await asyncio.gather(*(worker() for _ in range(min(parts, parts_in_flight))))
+    name = os.path.basename(path)
+    return InputFileBig(file_id, parts, name) if big else InputFile(file_id, parts, name, '')
+
+
+class MediaPipeline:
+    """
+    Transfers the media of copied messages ahead of the sender.
+
+    Each file (a message's photo or document, or a local file) is downloaded
+    and uploaded once per account in a background task. At most `workers`
+    transfers run at once. The sender schedules a whole batch up front, then
+    sends in order, waiting only for the file of the message it is sending;
+    text and files that are already uploaded go out while later files are
+    still transferring. Finished uploads are kept for UPLOAD_TTL seconds, so
+    sending the same file to another destination, or again after an error,
+    does not upload it again; after that, or after a failed transfer, the
+    file is transferred again the next time it is asked for. Telegram only
+    keeps uploaded parts for a limited time, so an old upload would fail
+    the send.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = asyncio.Semaphore(max(1, workers))
+        self.uploads = collections.OrderedDict()  # (account, file key) -> (task returning an InputFile, started)
+
+    @staticmethod
+    def _key(message, path):
+        if path:
+            return f'path:{path}'
+        if isinstance(message.media, MessageMediaPhoto):
+            return f'photo:{message.media.photo.id}'
+        return f'document:{message.media.document.id}'
+
+    async def _transfer(self, client, message, path):
+        async with self.workers:
+            if path:
+                return await upload(client, path)
+            directory = tempfile.mkdtemp(prefix='forward-media-')
+            try:
+                with metrics.timed('download_media'):
+                    downloaded = await client.download_media(message.media, file=directory)
+                return await upload(client, downloaded)
+            finally:
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+
+    def schedule(self, client, message, path: str = None) -> asyncio.Future:
+        """Start transferring the file of `message` (or the local file `path`) unless it is uploaded or on its way"""
+        key = (account_of(client), self._key(message, path))
+        task, started = self.uploads.get(key, (None, 0))
+        now = time.monotonic()
+        if task is None or now - started > UPLOAD_TTL or (task.done() and (task.cancelled() or task.exception())):
+            task = asyncio.ensure_future(self._transfer(client, message, path))
+            self.uploads[key] = (task, now)
+            self.uploads.move_to_end(key)
+            # Oldest first: drop the expired uploads, and the finished ones beyond UPLOAD_CACHE
+            while self.uploads:
+                oldest, oldest_started = next(iter(self.uploads.values()))
+                if not oldest.done() or (len(self.uploads) <= UPLOAD_CACHE and now - oldest_started <= UPLOAD_TTL):
+                    break
+                self.uploads.popitem(last=False)
+        return task
+
+    def prepare(self, client, album, files: dict = None) -> None:
+        """Start the transfers of an album that will be copied soon"""
+        for message in album:
+            if has_file(message):
+                self.schedule(client, message, files and files.get(message.id))
+
+    async def media(self, client, album, files: dict = None) -> list:
+        """The uploaded media of every message in `album`, with its original attributes, or None for text"""
+        result = []
+        for message in album:
+            path = files and files.get(message.id)
+            if not has_file(message):
+                result.append(None)
+                continue
+            uploaded = await self.schedule(client, message, path)
+            if isinstance(message.media, MessageMediaPhoto):
+                result.append(InputMediaUploadedPhoto(file=uploaded))
+            else:
+                document = message.media.document
+                result.append(InputMediaUploadedDocument(
+                    file=uploaded, mime_type=document.mime_type, attributes=document.attributes))
+        return result
+
+
+pipeline = MediaPipeline(MEDIA_WORKERS)